@@ -0,0 +1,266 @@
+'''
+Benchmarks for the detection models.
+python bench.py stages --source unnamed.png --frames 30 --size 1280x720 --threads 4
+python bench.py batch --image unnamed.png -n 10
+python bench.py human --image unnamed.png
+python bench.py backends --source unnamed.png --source recordings/field1 --sizes 800 640 480
+python bench.py text --text "a red skirt and a white top" "trousers please"
+Every run is appended as one JSON line to --out (default bench_results.jsonl) so runs can be compared across commits.
+'''
+import argparse
+import json
+import subprocess
+import time
+from collections import defaultdict
+from itertools import product
+from contextlib import contextmanager
+import numpy as np
+import cv2
+import torch
+from models import get_human_model, get_clothes_model, get_most_confident, crop_bbox, id_to_label, visualize, get_metadata, locate_person
+from display import draw_instances
+from recorder import read_frames
+
+def timeit(fn,repeats):
+    '''Returns seconds per call of fn, after one warm up call.'''
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats): fn()
+    return (time.perf_counter()-start)/repeats
+
+class StageTimer:
+    '''Collects wall time per named stage. with timer('stage'): ...'''
+    def __init__(self): self.times = defaultdict(list)
+
+    @contextmanager
+    def __call__(self,stage):
+        start = time.perf_counter()
+        try: yield
+        finally: self.times[stage].append(time.perf_counter()-start)
+
+    def add(self,stage,seconds): self.times[stage].append(seconds)
+
+    def summary(self):
+        '''{stage: {n, mean, p50, p95, p99}} in milliseconds.'''
+        out = {}
+        for stage,times in self.times.items():
+            ms = np.array(times)*1000.0
+            out[stage] = {'n':len(ms),'mean':float(ms.mean()),**{f'p{q}':float(np.percentile(ms,q)) for q in (50,95,99)}}
+        return out
+
+def git_commit():
+    try: return subprocess.check_output(['git','rev-parse','--short','HEAD'],stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError): return None
+
+def save_result(path,result):
+    with open(path,'a') as f: f.write(json.dumps(result)+'\n')
+
+def bench_stages(source,frames=30,size=None,threads=None,warmup=2,show=False,margin=0.05,
+        human_thres=(0.01,0.9),clothes_thres=(0.3,0.7),max_area=100000):
+    '''
+    Times each stage of a check_doll/grab_doll iteration over recorded frames. Returns (config, per stage summary, fps).
+    - source (string): recorded session directory, video file, image glob or image
+    - frames (int, default: 30): frames timed, after warmup untimed ones
+    - size (tuple, default: None): (w,h) to resize frames to, None keeps the source size
+    - threads (int, default: None): torch & OpenCV threads, None keeps the defaults
+    - show (bool, default: False): include cv2.imshow (needs a display)
+    '''
+    if threads is not None:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+    human_model = get_human_model(*human_thres)
+    clothes_model = get_clothes_model(*clothes_thres)
+
+    timer = StageTimer()
+    it = read_frames(source,frames+warmup,repeat=True)
+    n = 0
+    start = None
+    while True:
+        if n == warmup: #start timing only once the models are warm
+            timer,start = StageTimer(),time.perf_counter()
+        frame_start = time.perf_counter()
+        im = next(it,None)
+        if im is None: break #end of the source, nothing from this iteration is recorded
+        if size is not None: im = cv2.resize(im,size,interpolation=cv2.INTER_AREA)
+        timer.add('decode',time.perf_counter()-frame_start)
+        with timer('copy'): cur_im = im.copy()
+        with timer('human_model'): human_boxes = human_model(cur_im)
+        with timer('get_most_confident'): best_box = get_most_confident(human_boxes,0,max_area)
+        if len(best_box) > 0:
+            with timer('crop_bbox'): new_im,_ = crop_bbox(cur_im,best_box.tensor.tolist()[0],b=margin)
+            with timer('clothes_model'): outputs = clothes_model(new_im)['instances'].to('cpu')
+            with timer('id_to_label'): id_to_label(outputs.pred_classes.tolist())
+            with timer('visualize'):
+                human_vis = visualize(cur_im,human_boxes)
+                clothes_vis = visualize(new_im,{'instances':outputs})
+            with timer('draw'): #the OpenCV drawing the scripts use instead of visualize
+                draw_instances(cur_im.copy(),human_boxes,['person'])
+                draw_instances(new_im.copy(),outputs,get_metadata().thing_classes)
+            if show:
+                with timer('imshow'):
+                    cv2.imshow('Humanfeed',human_vis)
+                    cv2.imshow('Clothesfeed',clothes_vis)
+                    cv2.waitKey(1)
+        timer.add('total',time.perf_counter()-frame_start)
+        n += 1
+    timed = n-warmup
+    elapsed = time.perf_counter()-start if start is not None else 0.0
+    fps = timed/elapsed if elapsed > 0 else 0.0
+    config = {'source':source,'frames':timed,'size':size,'threads':threads if threads is not None else torch.get_num_threads(),
+        'human_thres':human_thres,'clothes_thres':clothes_thres,'margin':margin,'show':show}
+    return config,timer.summary(),fps
+
+def print_summary(summary,fps):
+    print(f"{'stage':<20}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage,s in summary.items():
+        print(f"{stage:<20}{s['n']:>5}{s['p50']:>10.1f}{s['p95']:>10.1f}{s['p99']:>10.1f}")
+    print(f'{fps:.2f} fps overall')
+
+def compare_batch(im,n=10,repeats=3):
+    '''Images/s of the per-image DefaultPredictor path vs one BatchPredictor pass over n copies of im.'''
+    ims = [im.copy() for _ in range(n)]
+    results = {}
+    for name,get_model in [('human',get_human_model),('clothes',get_clothes_model)]:
+        single,batched = get_model(),get_model(batch=True)
+        t_single = timeit(lambda: [single(x) for x in ims],repeats)
+        t_batch = timeit(lambda: batched(ims),repeats)
+        results[name] = {'per_image_fps':n/t_single,'batch_fps':n/t_batch,'speedup':t_single/t_batch}
+        print(f'{name}: per image {n/t_single:.2f} img/s, batch of {n} {n/t_batch:.2f} img/s ({t_single/t_batch:.2f}x)')
+    return results
+
+def box_iou(a,b):
+    ix = max(0.0,min(a[2],b[2])-max(a[0],b[0]))
+    iy = max(0.0,min(a[3],b[3])-max(a[1],b[1]))
+    inter = ix*iy
+    union = (a[2]-a[0])*(a[3]-a[1])+(b[2]-b[0])*(b[3]-b[1])-inter
+    return inter/union if union > 0 else 0.0
+
+def compare_human(im,repeats=5,modes=((True,'R101'),(False,'R101'),(False,'R50'))):
+    '''Latency of get_human_model with/without the keypoint head & per backbone, with the best box's IoU vs the first mode.'''
+    results,ref = {},None
+    for keypoints,backbone in modes:
+        model = get_human_model(batch=False,keypoints=keypoints,backbone=backbone)
+        latency = timeit(lambda: model(im),repeats)
+        best_box = get_most_confident(model(im),0,float('inf'))
+        box = best_box.tensor.tolist()[0] if len(best_box) > 0 else None
+        if ref is None: ref = box
+        iou = box_iou(ref,box) if ref is not None and box is not None else None
+        name = f"{backbone}{'+keypoints' if keypoints else ''}"
+        results[name] = {'latency_ms':latency*1000.0,'box':box,'iou_vs_first':iou}
+        print(f"{name:<16}{latency*1000.0:>8.1f} ms  iou vs {modes[0][1]}{'+keypoints' if modes[0][0] else ''}: {iou}")
+    return results
+
+def bench_backends(sources,frames=10,sizes=(800,640,480),backends=('eager','traced','onnx'),quantize=(False,True),
+        human_thres=(0.01,0.9),clothes_thres=(0.3,0.7),margin=0.05,repeats=2):
+    '''
+    Accuracy vs latency of each backend/quantisation/test size, against the eager float32 models at the default size (800).
+    Person: IoU of find_doll's box with the reference one (1 if both find none). Clothes: F1 of the predicted class sets on the reference crops.
+    Returns one dict per operating point.
+    - sources (list): images, image globs, videos or recorded sessions, frames of each are pooled
+    '''
+    ims = [im for source in sources for im in read_frames(source,frames,repeat=True)]
+    ref_human,ref_clothes = get_human_model(*human_thres),get_clothes_model(*clothes_thres)
+    ref_boxes = [locate_person(ref_human(im))[0] for im in ims]
+    crops = [crop_bbox(im,box,b=margin)[0] for im,box in zip(ims,ref_boxes) if box is not None]
+    ref_classes = [set(ref_clothes(crop)['instances'].pred_classes.tolist()) for crop in crops]
+    results,unavailable = [],set()
+    for backend,q,size in product(backends,quantize,sizes):
+        if backend in unavailable: continue
+        max_size = round(size*1333/800) #keeps detectron2's default aspect limit
+        try:
+            human = get_human_model(*human_thres,backend=backend,quantize=q,min_size=size,max_size=max_size)
+            clothes = get_clothes_model(*clothes_thres,backend=backend,quantize=q,min_size=size,max_size=max_size)
+        except ImportError as e: #eg. onnxruntime not installed
+            print(f'skipping {backend}: {e}')
+            unavailable.add(backend)
+            continue
+        human_ms = timeit(lambda: [human(im) for im in ims],repeats)/len(ims)*1000.0
+        clothes_ms = timeit(lambda: [clothes(crop) for crop in crops],repeats)/max(1,len(crops))*1000.0
+        ious = []
+        for im,ref in zip(ims,ref_boxes):
+            box = locate_person(human(im))[0]
+            ious.append(1.0 if box is None and ref is None else box_iou(ref,box) if box is not None and ref is not None else 0.0)
+        f1s = []
+        for crop,ref in zip(crops,ref_classes):
+            pred = set(clothes(crop)['instances'].pred_classes.tolist())
+            f1s.append(1.0 if not pred and not ref else 2*len(pred&ref)/(len(pred)+len(ref)))
+        r = {'backend':backend,'quantize':q,'min_size':size,'max_size':max_size,'human_ms':human_ms,'clothes_ms':clothes_ms,
+            'human_iou':float(np.mean(ious)),'clothes_f1':float(np.mean(f1s)) if f1s else None}
+        print(f"{backend:<8}{'int8' if q else 'fp32':<6}{size:>5}{human_ms:>10.1f} ms{r['human_iou']:>8.3f} iou{clothes_ms:>10.1f} ms{r['clothes_f1'] or 0:>8.3f} f1")
+        results.append(r)
+    return results
+
+DESCRIPTIONS = ["i love my skirt as well as my trousers so much!","a doll in a white top","she wears a dress",
+    "find the one with the jacket and trousers","blue skirt and a striped top"]
+
+def bench_text(descriptions=DESCRIPTIONS,repeats=3):
+    '''Startup (fastai import + learner load) of the text classifier, then ms per description: uncached, cached & batched.'''
+    from extract_clothes import get_clothes_class
+    start = time.perf_counter()
+    clothes_text = get_clothes_class(".","./encoded_words.pkl").load()
+    startup = time.perf_counter()-start
+    n = len(descriptions)
+    def uncached():
+        clothes_text.cache.clear()
+        for d in descriptions: clothes_text.process_input(d)
+    def batched():
+        clothes_text.cache.clear()
+        clothes_text.process_inputs(descriptions)
+    results = {'startup_s':startup,'uncached_ms':timeit(uncached,repeats)/n*1000.0,
+        'cached_ms':timeit(lambda: [clothes_text.process_input(d) for d in descriptions],repeats)/n*1000.0,
+        'batched_ms':timeit(batched,repeats)/n*1000.0}
+    print(f"startup {startup:.2f} s, per description: uncached {results['uncached_ms']:.1f} ms, cached {results['cached_ms']:.3f} ms, batch of {n} {results['batched_ms']:.1f} ms")
+    return results
+
+def parse_size(s):
+    w,h = s.lower().split('x')
+    return int(w),int(h)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out',default='bench_results.jsonl',help='file the results are appended to')
+    sub = parser.add_subparsers(dest='bench',required=True)
+    p = sub.add_parser('stages',help='per-stage latency of the detection loop')
+    p.add_argument('--source',default='./unnamed.png',help='recorded session, video file, image glob or image')
+    p.add_argument('--frames',type=int,default=30)
+    p.add_argument('--size',type=parse_size,default=None,help='WxH to resize frames to, eg. 1280x720')
+    p.add_argument('--threads',type=int,default=None)
+    p.add_argument('--warmup',type=int,default=2)
+    p.add_argument('--show',action='store_true',help='include cv2.imshow')
+    p.add_argument('--human-thres',type=float,nargs=2,default=(0.01,0.9),metavar=('NMS','SCORE'))
+    p.add_argument('--clothes-thres',type=float,nargs=2,default=(0.3,0.7),metavar=('NMS','SCORE'))
+    p = sub.add_parser('batch',help='per-image vs batched predictor throughput')
+    p.add_argument('--image',default='./unnamed.png')
+    p.add_argument('-n',type=int,default=10,help='images per batch')
+    p.add_argument('--repeats',type=int,default=3)
+    p = sub.add_parser('human',help='person detector latency with/without keypoints & per backbone')
+    p.add_argument('--image',default='./unnamed.png')
+    p.add_argument('--repeats',type=int,default=5)
+    p = sub.add_parser('backends',help='accuracy vs latency per backend, quantisation & test size')
+    p.add_argument('--source',action='append',default=None,help='image, image glob, video or recorded session, can be repeated (default unnamed.png)')
+    p.add_argument('--frames',type=int,default=10,help='frames per source')
+    p.add_argument('--sizes',type=int,nargs='+',default=[800,640,480],help='INPUT.MIN_SIZE_TEST values')
+    p.add_argument('--backends',nargs='+',default=['eager','traced','onnx'])
+    p.add_argument('--repeats',type=int,default=2)
+    p = sub.add_parser('text',help='text to clothing classifier startup & latency per description')
+    p.add_argument('--text',nargs='+',default=DESCRIPTIONS,help='descriptions to classify')
+    p.add_argument('--repeats',type=int,default=3)
+    args = parser.parse_args()
+
+    if args.bench == 'stages':
+        config,summary,fps = bench_stages(args.source,args.frames,args.size,args.threads,args.warmup,args.show,
+            human_thres=tuple(args.human_thres),clothes_thres=tuple(args.clothes_thres))
+        print_summary(summary,fps)
+        result = {'bench':'stages','config':config,'stages':summary,'fps':fps}
+    elif args.bench == 'batch':
+        result = {'bench':'batch','config':{'image':args.image,'n':args.n},'results':compare_batch(cv2.imread(args.image),args.n,args.repeats)}
+    elif args.bench == 'human':
+        result = {'bench':'human','config':{'image':args.image},'results':compare_human(cv2.imread(args.image),args.repeats)}
+    elif args.bench == 'backends':
+        sources = args.source or ['./unnamed.png']
+        result = {'bench':'backends','config':{'sources':sources,'frames':args.frames},
+            'results':bench_backends(sources,args.frames,tuple(args.sizes),tuple(args.backends),repeats=args.repeats)}
+    elif args.bench == 'text':
+        result = {'bench':'text','config':{'descriptions':len(args.text)},'results':bench_text(args.text,args.repeats)}
+    result.update(commit=git_commit(),time=time.time())
+    save_result(args.out,result)
@@ -0,0 +1,108 @@
+import cv2
+from threading import Thread, Condition
+
+COLOURS = [(0,200,0),(0,140,255),(255,80,0),(200,0,200),(0,200,200),(80,80,255)] #BGR, picked by class id
+
+def draw_detections(im,boxes,labels=None,scores=None,classes=None,offset=(0,0)):
+    '''
+    Draws boxes with their labels & scores onto im in-place using plain OpenCV primitives. Returns im.
+    - boxes (list): [x1,y1,x2,y2] per detection
+    - labels (list, default: None): text per detection
+    - scores (list, default: None): confidence per detection
+    - classes (list, default: None): class id per detection, picks the colour
+    - offset (tuple, default: (0,0)): added to the boxes, eg. to draw crop detections on the full frame
+    '''
+    ox,oy = offset
+    for i,(x1,y1,x2,y2) in enumerate(boxes):
+        colour = COLOURS[(classes[i] if classes is not None else 0)%len(COLOURS)]
+        p1,p2 = (int(x1+ox),int(y1+oy)),(int(x2+ox),int(y2+oy))
+        cv2.rectangle(im,p1,p2,colour,2)
+        text = ' '.join(t for t in (labels[i] if labels is not None else '',f'{scores[i]:.2f}' if scores is not None else '') if t)
+        if not text: continue
+        (tw,th),_ = cv2.getTextSize(text,cv2.FONT_HERSHEY_SIMPLEX,0.5,1)
+        cv2.rectangle(im,(p1[0],p1[1]-th-4),(p1[0]+tw,p1[1]),colour,-1)
+        cv2.putText(im,text,(p1[0],p1[1]-3),cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,255,255),1,cv2.LINE_AA)
+    return im
+
+def draw_instances(im,instances,class_names=None):
+    '''draw_detections for detectron2 Instances (or {'instances': Instances}).'''
+    if isinstance(instances,dict): instances = instances['instances']
+    instances = instances.to('cpu')
+    classes = instances.pred_classes.tolist() if instances.has('pred_classes') else None
+    labels = [class_names[c] for c in classes] if class_names is not None and classes is not None else None
+    return draw_detections(im,instances.pred_boxes.tensor.tolist(),labels,instances.scores.tolist(),classes)
+
+class Display:
+    '''
+    Shows frames from its own thread, so drawing & window polling stay out of the control loops.
+    Each window only keeps the newest frame handed to it, frames that arrive while the thread is busy replace the stale one.
+    Only the display thread touches OpenCV's GUI functions.
+    - windows (list, default: ()): window names to open up front
+    - headless (bool, default: False): no windows at all, show() does nothing and closed() is always False
+    - poll_ms (int, default: 10): how long each cv2.waitKey lasts
+    '''
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def __init__(self,windows=(),headless=False,poll_ms=10):
+        self.windows = list(windows)
+        self.headless = headless
+        self.poll_ms = poll_ms
+        self.latest = {} #window name -> (image, draw callable or None), waiting to be shown
+        self.shown = set()
+        self.closed_windows = set()
+        self.dropped = 0 #frames replaced before they were shown
+        self.running = False
+        self.cond = Condition()
+        self.thread = Thread(target=self.__run,daemon=True)
+
+    def start(self):
+        if self.headless: return self
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if not self.running: return
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def show(self,name,im,draw=None):
+        '''
+        Queue im for window name. Returns immediately.
+        - draw (callable, default: None): draw(im) called on the display thread before showing, eg. lambda im: draw_instances(im,outputs)
+        im must not be modified by the caller afterwards, it is drawn on in place if draw is given.
+        '''
+        if self.headless: return
+        with self.cond:
+            if name in self.latest: self.dropped += 1
+            self.latest[name] = (im,draw)
+            self.cond.notify()
+
+    def show_instances(self,name,im,instances,class_names=None):
+        '''Show im with detectron2 detections drawn on a copy of it.'''
+        if self.headless: return
+        self.show(name,im.copy(),lambda im: draw_instances(im,instances,class_names))
+
+    def closed(self,name):
+        '''Whether the user closed window name.'''
+        return name in self.closed_windows
+
+    def __run(self):
+        for name in self.windows: cv2.namedWindow(name,cv2.WINDOW_AUTOSIZE)
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.latest or not self.running,timeout=self.poll_ms/1000.0)
+                if not self.running: break
+                todo,self.latest = self.latest,{}
+            for name,(im,draw) in todo.items():
+                if name in self.closed_windows: continue
+                if draw is not None: draw(im)
+                cv2.imshow(name,im)
+                self.shown.add(name)
+            cv2.waitKey(self.poll_ms)
+            for name in self.shown-self.closed_windows:
+                if cv2.getWindowProperty(name,cv2.WND_PROP_VISIBLE) < 1: self.closed_windows.add(name)
+        cv2.destroyAllWindows()
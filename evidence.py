@@ -0,0 +1,75 @@
+import math
+import numpy as np
+
+def normal_cdf(z): return 0.5*(1.0+math.erf(z/math.sqrt(2.0)))
+
+class EvidenceAggregator:
+    '''
+    Sequential accept/reject test over per-frame class scores, so easy cases stop after a few frames & only ambiguous ones use them all.
+    Each frame's score is class_scores@weights. The test accepts once the mean score is above threshold with the given confidence,
+    rejects once it is below with the same confidence, and otherwise decides on the mean after max_frames.
+    Only fresh frames count: a cached result repeats an earlier frame's scores, so counting it again would shrink the variance
+    & fake confidence.
+    - weights (array): weight per class, eg. 1 for wanted clothes & a negative one for the rest
+    - threshold (number): mean per frame score to accept above
+    - confidence (number, default: 0.95): probability the mean is on one side of threshold needed to stop early
+    - min_frames (int, default: 3): fresh frames before stopping early is considered
+    - max_frames (int, default: 10): fresh frames after which it decides anyway
+    - min_std (number, default: 0.2): floor on the per frame score's standard deviation, so a few agreeing frames aren't taken as certain
+    '''
+    def __init__(self,weights,threshold,confidence=0.95,min_frames=3,max_frames=10,min_std=0.2):
+        self.weights = np.asarray(weights,dtype=float)
+        self.threshold = threshold
+        self.confidence = confidence
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.min_std = min_std
+        self.class_sums = np.zeros(len(self.weights)) #summed score per class
+        self.frames = 0 #fresh frames counted
+        self.cached = 0 #cached results skipped
+        self.mean = 0.0 #running mean & sum of squared deviations of the frame scores (Welford)
+        self.m2 = 0.0
+        self.decision = None #True accepted, False rejected, None still undecided
+
+    @property
+    def class_means(self):
+        '''Belief per class: its mean score over the frames so far.'''
+        return self.class_sums/max(1,self.frames)
+
+    @property
+    def p_accept(self):
+        '''Probability the mean frame score is above threshold, from a normal approximation.'''
+        if self.frames == 0: return 0.5
+        std = max(self.min_std,math.sqrt(self.m2/(self.frames-1)) if self.frames > 1 else 0.0)
+        return normal_cdf((self.mean-self.threshold)/(std/math.sqrt(self.frames)))
+
+    @property
+    def done(self): return self.decision is not None
+
+    def update(self,class_scores,fresh=True):
+        '''
+        Adds one frame's scores (one per class). Returns the decision, None while undecided.
+        - fresh (bool, default: True): False for results reused from a cache (eg. MotionGate), they are skipped
+        '''
+        if self.done: return self.decision
+        if not fresh:
+            self.cached += 1
+            return self.decision
+        class_scores = np.asarray(class_scores,dtype=float)
+        self.class_sums += class_scores
+        score = float(class_scores@self.weights)
+        self.frames += 1
+        delta = score-self.mean
+        self.mean += delta/self.frames
+        self.m2 += delta*(score-self.mean)
+        if self.frames >= self.min_frames:
+            p = self.p_accept
+            if p >= self.confidence: self.decision = True
+            elif p <= 1.0-self.confidence: self.decision = False
+        if self.decision is None and self.frames >= self.max_frames: self.decision = self.mean > self.threshold
+        return self.decision
+
+    def result(self):
+        '''Decision so far, falling back to the mean if stopped before the test finished (False without any frames).'''
+        if self.done: return self.decision
+        return self.frames > 0 and self.mean > self.threshold
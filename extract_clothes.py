@@ -1,33 +1,90 @@
 import pickle
-from fastai.text import *
+from collections import OrderedDict
+from threading import Lock
 
 class get_clothes_class():
-    def __init__(self, model_path, encoded_word_dict_path):
+    def __init__(self, model_path, encoded_word_dict_path, cache_size=256):
+        '''
+        Text to clothing classifier. fastai is only imported & the learner only loaded on first use (or load()), so importing this is cheap.
+        - cache_size (int, default: 256): predictions kept (least recently used go first), keyed by the encoded input
+        '''
         self.classes = ["outwear", "top", "trousers", "women dresses", "women skirts"]
-        ### Import model
-        self.newlearn = load_learner(model_path, "export.pkl")
+        self.model_path = model_path
+        self.newlearn = None
+        self.load_lock = Lock()
+        self.lock = Lock() #guards the cache
+        self.cache = OrderedDict() #encoded input -> tuple of classes
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
         ### Import decoding dictionary
         with open(encoded_word_dict_path, 'rb') as f:
             self.word_keys = pickle.load(f)
-            f.close()
-    
+
+    def load(self):
+        '''Import fastai & load the learner if not done yet, eg. from a background thread at startup.'''
+        with self.load_lock:
+            if self.newlearn is None:
+                from fastai.text import load_learner
+                ### Import model
+                self.newlearn = load_learner(self.model_path, "export.pkl")
+        return self
+
     '''plaintext to encoded words format'''
     def _encode_input(self, raw_string):
-        raw_string_list = raw_string.split()
-        encoded_string_list = [self.word_keys[i.lower()] for i in raw_string_list if i.lower() in self.word_keys.keys()]
-        return ' '.join(encoded_string_list)    
-    
-    '''to process the encoded words for model prediction'''    
+        words = (w.lower() for w in raw_string.split())
+        return ' '.join(self.word_keys[w] for w in words if w in self.word_keys)
+
+    def _to_classes(self, pred):
+        return tuple(self.classes[idx] for idx, item in enumerate(pred) if item==1)
+
+    def _cache_get(self, encoded):
+        with self.lock:
+            if encoded not in self.cache:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache.move_to_end(encoded)
+            return self.cache[encoded]
+
+    def _cache_put(self, encoded, classes):
+        with self.lock:
+            self.cache[encoded] = classes
+            self.cache.move_to_end(encoded)
+            while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+
+    '''to process the encoded words for model prediction'''
     def process_input(self, input_string):
 
         # Convert words into encoded input
         encoded_input_string = self._encode_input(input_string)
         print('encoded words: ', encoded_input_string)
-        # Pass the processed input into the prediction
-        result = self.newlearn.predict(encoded_input_string)[1].numpy()
-        #Get classes result
-        detected_classes = [self.classes[idx] for idx, item in enumerate(result) if item==1]
-        return detected_classes
+        #Cached by the encoded input, so rewordings that encode the same skip the model too
+        detected_classes = self._cache_get(encoded_input_string)
+        if detected_classes is None:
+            # Pass the processed input into the prediction
+            result = self.load().newlearn.predict(encoded_input_string)[1].numpy()
+            #Get classes result
+            detected_classes = self._to_classes(result)
+            self._cache_put(encoded_input_string, detected_classes)
+        return list(detected_classes)
+
+    def process_inputs(self, input_strings):
+        '''process_input for a list of descriptions, the ones not cached go through the model in one padded batch.'''
+        encoded = [self._encode_input(s) for s in input_strings]
+        results = {}
+        for e in set(encoded):
+            classes = self._cache_get(e)
+            if classes is not None: results[e] = classes
+        todo = sorted(set(encoded)-set(results))
+        if todo:
+            from fastai.basic_data import DatasetType
+            learn = self.load().newlearn
+            learn.data.add_test(todo)
+            raw_preds,_ = learn.get_preds(ds_type=DatasetType.Test, ordered=True) #ordered undoes the sort by length used for padding
+            for e, raw in zip(todo, raw_preds):
+                results[e] = self._to_classes(learn.data.single_ds.y.analyze_pred(raw).numpy()) #same 0.5 threshold as predict
+                self._cache_put(e, results[e])
+        return [list(results[e]) for e in encoded]
 
 
 ### Example usage ###
@@ -35,4 +92,5 @@ class get_clothes_class():
 # result = clothes.process_input("i love my skirt as well as my trousers so much!")
 # print(result)
 
-# Output: ['trousers', 'women skirts']
\ No newline at end of file
+# Output: ['trousers', 'women skirts']
+# clothes.process_inputs(["red skirt please", "a top and trousers"]) #one forward pass for both
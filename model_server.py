@@ -0,0 +1,210 @@
+'''
+Runs the human & clothes predictors in worker processes, so inference doesn't hold the GIL of the process doing video, sockets & control.
+Frames go to the workers through preallocated shared memory slots (sized for 720p BGR), only a small task message is pickled.
+
+server = ModelServer(workers=4).start(wait=True) #start it before other threads, workers are forked on Linux
+human_model = server.client('human') #human_model(im) works like get_human_model()(im)
+server.submit('human',im)            #non-blocking, returns a Future
+server.latest('human')               #(task id, outputs) of the newest finished result, never blocks
+'''
+import os
+import multiprocessing as mp
+import numpy as np
+import torch
+from itertools import count
+from queue import Queue, Empty
+from threading import Thread, Lock, Condition
+from concurrent.futures import Future
+from detectron2.structures import Boxes, Instances
+
+FRAME_SHAPE = (720,1280,3) #largest frame a slot holds
+
+def _worker(specs,tasks,results,slots,threads):
+    '''Worker process: builds the predictors once, then runs tasks until it gets None.'''
+    try:
+        from models import get_human_model, get_clothes_model
+        torch.set_num_threads(threads)
+        getters = {'human':get_human_model,'clothes':get_clothes_model}
+        predictors = {name:getters[name](**kwargs) for name,kwargs in specs.items()}
+    except BaseException as e: #eg. missing weights, out of memory
+        results.put(('failed',os.getpid(),repr(e)))
+        return
+    views = [np.frombuffer(s,dtype=np.uint8) for s in slots]
+    results.put(('ready',os.getpid(),None))
+    while True:
+        task = tasks.get()
+        if task is None: break
+        task_id,name,slot,shape = task
+        try:
+            im = views[slot][:int(np.prod(shape))].reshape(shape)
+            instances = predictors[name](im)['instances'].to('cpu')
+            results.put((task_id,None,{
+                'image_size':instances.image_size,
+                'boxes':instances.pred_boxes.tensor.numpy(),
+                'scores':instances.scores.numpy(),
+                'classes':instances.pred_classes.numpy()}))
+        except Exception as e:
+            results.put((task_id,repr(e),None))
+
+def to_outputs(result):
+    '''Rebuilds the {'instances': Instances} a DefaultPredictor would return.'''
+    instances = Instances(tuple(result['image_size']))
+    instances.pred_boxes = Boxes(torch.from_numpy(result['boxes']))
+    instances.scores = torch.from_numpy(result['scores'])
+    instances.pred_classes = torch.from_numpy(result['classes'])
+    return {'instances':instances}
+
+class ModelClient:
+    '''Callable stand-in for a predictor, backed by a ModelServer.'''
+    def __init__(self,server,name):
+        self.server = server
+        self.name = name
+
+    def __call__(self,im): return self.server.submit(self.name,im).result()
+
+    def predict_many(self,images):
+        '''Sends all images before waiting on any, so they run on several workers at once.'''
+        futures = [self.server.submit(self.name,im) for im in images]
+        return [f.result() for f in futures]
+
+    def latest(self): return self.server.latest(self.name)
+
+class ModelServer:
+    '''
+    Pool of worker processes each holding the predictors, fed through shared memory frame slots.
+    - human (dict, default: {}): get_human_model kwargs, None to not load it
+    - clothes (dict, default: {}): get_clothes_model kwargs, None to not load it
+    - workers (int, default: None): worker processes, None uses one per 2 cores
+    - slots (int, default: None): shared frame buffers, None is 2 per worker. submit() blocks while all are in use
+    - frame_shape (tuple, default: FRAME_SHAPE): largest frame a slot can take
+    - start_method (string, default: None): multiprocessing start method, None is the platform default.
+      With 'spawn' the main script is re-imported in each worker, so it needs an if __name__ == "__main__" guard
+    '''
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def __init__(self,human={},clothes={},workers=None,slots=None,frame_shape=FRAME_SHAPE,start_method=None):
+        self.specs = {name:kwargs for name,kwargs in (('human',human),('clothes',clothes)) if kwargs is not None}
+        self.workers = workers if workers is not None else max(1,(os.cpu_count() or 2)//2)
+        self.frame_shape = frame_shape
+        ctx = mp.get_context(start_method)
+        self.ctx = ctx
+        self.slots = [ctx.RawArray('B',int(np.prod(frame_shape))) for _ in range(slots if slots is not None else 2*self.workers)]
+        self.views = [np.frombuffer(s,dtype=np.uint8) for s in self.slots]
+        self.free_slots = Queue()
+        for i in range(len(self.slots)): self.free_slots.put(i)
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.procs = []
+        self.pending = {} #task id -> (Future, slot, model name)
+        self.latest_results = {} #model name -> (task id, outputs)
+        self.lock = Lock()
+        self.ids = count()
+        self.ready = 0 #workers that finished loading their models
+        self.error = None #set once a worker failed, the server is unusable from then on
+        self.stopping = False
+        self.state = Condition() #notified when ready or error change
+        self.collector = Thread(target=self.__collect,daemon=True)
+
+    def start(self,wait=False,timeout=None):
+        '''
+        Starts the workers. Submitted frames queue up until their models are loaded.
+        - wait (bool, default: False): block until every worker has loaded its models, raises RuntimeError if one failed
+        - timeout (number, default: None): seconds to wait, TimeoutError after that
+        '''
+        threads = max(1,(os.cpu_count() or 1)//self.workers) #split the cores between workers
+        for _ in range(self.workers):
+            p = self.ctx.Process(target=_worker,args=(self.specs,self.tasks,self.results,self.slots,threads),daemon=True)
+            p.start()
+            self.procs.append(p)
+        self.collector.start()
+        if wait: self.wait_ready(timeout)
+        return self
+
+    def wait_ready(self,timeout=None):
+        '''Blocks until every worker has loaded its models. Raises RuntimeError if one failed, TimeoutError after timeout seconds.'''
+        with self.state:
+            if not self.state.wait_for(lambda: self.ready == self.workers or self.error is not None,timeout):
+                raise TimeoutError(f'{self.ready}/{self.workers} model server workers ready after {timeout}s')
+        if self.error is not None: raise RuntimeError(self.error)
+
+    def stop(self):
+        self.stopping = True
+        for p in self.procs:
+            if p.is_alive(): self.tasks.put(None)
+        for p in self.procs: p.join()
+        self.results.put(None)
+        self.collector.join()
+        self.__fail_pending('model server stopped')
+
+    def client(self,name):
+        '''Predictor-like callable for model name ('human' or 'clothes').'''
+        if name not in self.specs: raise KeyError(f'{name} model is not loaded')
+        return ModelClient(self,name)
+
+    def submit(self,name,im):
+        '''Queues im for model name and returns a Future of its outputs. Blocks only while every slot is in use.'''
+        if im.dtype != np.uint8 or im.size > self.views[0].size: raise ValueError(f'frames must be uint8 and at most {self.frame_shape}')
+        while True: #don't block forever on slots a dead worker will never give back
+            if self.error is not None: raise RuntimeError(self.error)
+            try:
+                slot = self.free_slots.get(timeout=0.5)
+                break
+            except Empty: continue
+        self.views[slot][:im.size] = im.reshape(-1) #the only copy, straight into shared memory
+        fut = Future()
+        task_id = next(self.ids)
+        with self.lock:
+            if self.error is not None: #failed while we were copying
+                self.free_slots.put(slot)
+                raise RuntimeError(self.error)
+            self.pending[task_id] = (fut,slot,name)
+        self.tasks.put((task_id,name,slot,im.shape))
+        return fut
+
+    def latest(self,name):
+        '''(task id, outputs) of the newest finished result for model name, or None. Never blocks.'''
+        return self.latest_results.get(name)
+
+    def __fail(self,error):
+        '''Marks the server unusable & fails everything in flight, their tasks may never be answered.'''
+        with self.state:
+            if self.error is None: self.error = error
+            self.state.notify_all()
+        self.__fail_pending(error)
+
+    def __fail_pending(self,error):
+        with self.lock: pending,self.pending = self.pending,{}
+        for fut,slot,_ in pending.values():
+            self.free_slots.put(slot)
+            if not fut.done(): fut.set_exception(RuntimeError(error))
+
+    def __collect(self):
+        while True:
+            try: msg = self.results.get(timeout=0.5)
+            except Empty:
+                dead = [p for p in self.procs if not p.is_alive()]
+                if dead and not self.stopping and self.error is None:
+                    self.__fail(f'model server worker {dead[0].pid} exited with code {dead[0].exitcode}')
+                continue
+            if msg is None: break
+            task_id,error,result = msg
+            if task_id == 'ready':
+                with self.state:
+                    self.ready += 1
+                    self.state.notify_all()
+                continue
+            if task_id == 'failed':
+                self.__fail(f'model server worker {error} could not load its models: {result}')
+                continue
+            with self.lock:
+                if task_id not in self.pending: continue #already failed
+                fut,slot,name = self.pending.pop(task_id)
+            self.free_slots.put(slot)
+            if error is not None:
+                fut.set_exception(RuntimeError(error))
+                continue
+            outputs = to_outputs(result)
+            prev = self.latest_results.get(name)
+            if prev is None or prev[0] < task_id: self.latest_results[name] = (task_id,outputs)
+            fut.set_result(outputs)
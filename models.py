@@ -1,51 +1,250 @@
 import numpy as np
 import cv2
+import io
+import os
+import json
+import tempfile
+import hashlib
 from pathlib import Path
+from collections import namedtuple
+from functools import lru_cache
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+import torch
 
 from detectron2 import model_zoo
 from detectron2.engine.defaults import DefaultPredictor
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer
-from detectron2.data import MetadataCatalog,DatasetCatalog,build_detection_train_loader
-from detectron2.data.datasets import register_coco_instances
+from detectron2.data import MetadataCatalog
 from detectron2.structures import Boxes, Instances, BoxMode
+from detectron2.modeling import build_model
+from detectron2.checkpoint import DetectionCheckpointer
+from fvcore.common.file_io import PathManager
+import detectron2.data.transforms as T
 
 #Paths
 base_dir = Path('.')
 human_model_path = base_dir/"model_final_997cc7.pkl"
 clothes_model_path = base_dir/"ft-til_resnet101_rcnn_moda_aug-147999-best_val.pth"
 categories_json = base_dir/"categories.json"
-DatasetCatalog.clear()
-register_coco_instances("categories", {}, categories_json, base_dir)
+weights_cache_dir = base_dir/".weights_cache"
+HUMAN_CONFIGS = { #person detector backbones, all keypoint R-CNNs trained on COCO people (1 class)
+    'R101': ("COCO-Keypoints/keypoint_rcnn_R_101_FPN_3x.yaml",str(human_model_path)),
+    'R50': ("COCO-Keypoints/keypoint_rcnn_R_50_FPN_3x.yaml",None), #weights from the model zoo
+}
 
+def load_weights(model,weights_path):
+    '''
+    Loads weights into model. The first load goes through detectron2's checkpointer (slow for the model zoo .pkl),
+    after which the matched state_dict is saved with torch.save so restarts only have to read it back.
+    The cache is written to a temp file & renamed into place, and an unreadable one falls back to the checkpointer.
+    weights_path can also be a model zoo URL, it is downloaded once.
+    '''
+    weights_path = Path(PathManager.get_local_path(str(weights_path)))
+    state = model.state_dict()
+    layout = hashlib.md5(','.join(f'{k}{tuple(v.shape)}' for k,v in state.items()).encode()).hexdigest()[:8] #same file can be loaded into different architectures
+    cached = weights_cache_dir/f'{weights_path.stem}-{int(weights_path.stat().st_mtime)}-{layout}.pth'
+    if cached.exists():
+        try:
+            model.load_state_dict(torch.load(cached,map_location='cpu'))
+            return
+        except Exception as e: #eg. truncated by a crash, rebuilt below
+            print(f'Ignoring unreadable weights cache {cached}: {e}')
+    DetectionCheckpointer(model).load(str(weights_path))
+    weights_cache_dir.mkdir(exist_ok=True)
+    fd,tmp = tempfile.mkstemp(dir=weights_cache_dir,suffix='.tmp') #several processes can build the same model at once
+    try:
+        with os.fdopen(fd,'wb') as f: torch.save(model.state_dict(),f)
+        os.replace(tmp,cached) #atomic, readers see the old file or the whole new one
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
-cfg_human = get_cfg()
-cfg_human.merge_from_file(model_zoo.get_config_file("COCO-Keypoints/keypoint_rcnn_R_101_FPN_3x.yaml"))
-cfg_human.MODEL.WEIGHTS = str(human_model_path)
+class BatchPredictor:
+    '''
+    Same preprocessing as DefaultPredictor, but takes a list of BGR images and runs them through the model in a single forward pass.
+    Each image is resized to the test size, then the model pads them all into one tensor batch. Returns one {'instances': Instances} per image.
+    Calling it with a single image behaves exactly like DefaultPredictor.
+    '''
+    def __init__(self,cfg):
+        self.cfg = cfg.clone()
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        load_weights(self.model,cfg.MODEL.WEIGHTS)
+        self.transform_gen = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST,cfg.INPUT.MIN_SIZE_TEST],cfg.INPUT.MAX_SIZE_TEST)
+        self.input_format = cfg.INPUT.FORMAT
 
-def get_human_model(nms_thres=0.0,score_thres=0.995):
-    cfg_human.MODEL.ROI_HEADS.NMS_THRESH_TEST = nms_thres #IoU aka overlap suppression (suppress if overlap > threshold)
-    cfg_human.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_thres #this isnt a confidence score filter... but seems to correlate well anyways
-    human_model = DefaultPredictor(cfg_human)
-    return human_model
+    def __call__(self,images):
+        if isinstance(images,np.ndarray): return self([images])[0]
+        if len(images) == 0: return []
+        inputs = []
+        for im in images:
+            if self.input_format == "RGB": im = im[:,:,::-1]
+            h,w = im.shape[:2]
+            im = self.transform_gen.get_transform(im).apply_image(im)
+            inputs.append({"image":torch.as_tensor(im.astype("float32").transpose(2,0,1)),"height":h,"width":w})
+        with torch.no_grad():
+            return self.model(inputs)
 
+def predict_many(model,images):
+    '''Run a predictor over a list of images, in one pass if it is a BatchPredictor.'''
+    if isinstance(model,BatchPredictor): return model(images)
+    if hasattr(model,'predict_many'): return model.predict_many(images) #eg. model_server clients
+    return [model(im) for im in images]
 
-cfg_clothes = get_cfg()
-cfg_clothes.merge_from_file(model_zoo.get_config_file("COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml"))
-cfg_clothes.MODEL.WEIGHTS = str(clothes_model_path)
-cfg_clothes.MODEL.ROI_HEADS.NUM_CLASSES = 5
+BACKENDS = ('eager','traced','onnx')
 
-cfg_clothes.DATASETS.TRAIN = ("categories",)
-build_detection_train_loader(cfg_clothes) #force meta to load
-metadata = MetadataCatalog.get("categories")
-print(metadata)
-def id_to_label(ids): return [metadata.thing_classes[id] for id in ids]
+class _TupleBackbone(torch.nn.Module):
+    '''Backbone returning its features as a tuple, which tracing & ONNX export need.'''
+    def __init__(self,backbone,names):
+        super().__init__()
+        self.backbone = backbone
+        self.names = names
 
-def get_clothes_model(nms_thres=0.2,score_thres=0.6):
-    cfg_clothes.MODEL.ROI_HEADS.NMS_THRESH_TEST = nms_thres
-    cfg_clothes.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_thres
-    clothes_model = DefaultPredictor(cfg_clothes)
-    return clothes_model
+    def forward(self,x):
+        features = self.backbone(x)
+        return tuple(features[n] for n in self.names)
+
+class _OnnxRunner:
+    '''Runs an exported backbone with onnxruntime, taking & returning torch tensors.'''
+    def __init__(self,module,example):
+        import onnxruntime as ort #optional, only needed for backend='onnx'
+        buf = io.BytesIO()
+        names = [f'p{i}' for i in range(len(module.names))]
+        torch.onnx.export(module,example,buf,input_names=['image'],output_names=names,opset_version=11,
+            dynamic_axes={'image':{2:'h',3:'w'},**{n:{2:f'{n}_h',3:f'{n}_w'} for n in names}})
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(buf.getvalue(),opts)
+
+    def __call__(self,x): return tuple(torch.from_numpy(f) for f in self.session.run(None,{'image':x.cpu().numpy()}))
+
+class CompiledBackbone(torch.nn.Module):
+    '''Stands in for a detectron2 backbone, running a traced or ONNX version of it but returning the same feature dict.'''
+    def __init__(self,backbone,backend,example):
+        super().__init__()
+        self.size_divisibility = backbone.size_divisibility
+        self.shapes = backbone.output_shape()
+        self.names = list(self.shapes)
+        module = _TupleBackbone(backbone,self.names).eval()
+        with torch.no_grad():
+            if backend == 'traced': self.run = torch.jit.trace(module,example)
+            elif backend == 'onnx': self.run = _OnnxRunner(module,example)
+            else: raise ValueError(f'backend must be one of {BACKENDS}')
+
+    def output_shape(self): return self.shapes
+
+    def forward(self,x): return dict(zip(self.names,self.run(x)))
+
+def optimise_model(model,cfg,backend='eager',quantize=False):
+    '''
+    Swaps parts of a loaded GeneralizedRCNN for faster CPU versions, in place. Proposal & ROI logic stays eager, it is data dependent.
+    - backend (string, default: 'eager'): 'traced' runs the backbone (most of the FLOPs) as TorchScript, 'onnx' with onnxruntime
+    - quantize (bool, default: False): dynamic int8 quantisation of the ROI heads' fully connected layers
+    '''
+    if backend != 'eager':
+        size = cfg.INPUT.MIN_SIZE_TEST
+        div = max(1,model.backbone.size_divisibility)
+        h,w = (size+div-1)//div*div,(size*16//9+div-1)//div*div #a 16:9 frame at the test size, other shapes still work
+        model.backbone = CompiledBackbone(model.backbone,backend,torch.zeros(1,3,h,w,device=model.device))
+    if quantize: model.roi_heads = torch.quantization.quantize_dynamic(model.roi_heads,{torch.nn.Linear},dtype=torch.qint8)
+    return model
+
+def build_predictor(cfg,batch=False,backend='eager',quantize=False):
+    '''
+    DefaultPredictor (or BatchPredictor) for cfg, with weights going through the load_weights cache. See optimise_model for the rest.
+    The optimised backends & quantisation are CPU only, so they build the model on the CPU whatever cfg.MODEL.DEVICE says.
+    '''
+    if backend != 'eager' or quantize:
+        cfg = cfg.clone()
+        cfg.MODEL.DEVICE = 'cpu'
+    if batch:
+        predictor = BatchPredictor(cfg)
+    else:
+        cfg = cfg.clone()
+        weights,cfg.MODEL.WEIGHTS = cfg.MODEL.WEIGHTS,'' #empty path makes DefaultPredictor skip loading
+        predictor = DefaultPredictor(cfg)
+        load_weights(predictor.model,weights)
+    optimise_model(predictor.model,cfg,backend,quantize)
+    return predictor
+
+_predictors = {} #finished predictors by (model, nms_thres, score_thres, batch, ...)
+_predictors_lock = Lock()
+
+def cached_predictor(key,make_cfg,batch,backend='eager',quantize=False):
+    with _predictors_lock: #so a background warm up and the main thread don't both build the same model
+        if key not in _predictors: _predictors[key] = build_predictor(make_cfg(),batch,backend,quantize)
+        return _predictors[key]
+
+def set_test_size(cfg,min_size=None,max_size=None):
+    '''Overrides INPUT.MIN/MAX_SIZE_TEST, the size images are resized to before the model. None keeps the config's (800/1333).'''
+    if min_size is not None: cfg.INPUT.MIN_SIZE_TEST = min_size
+    if max_size is not None: cfg.INPUT.MAX_SIZE_TEST = max_size
+    return cfg
+
+@lru_cache(maxsize=None)
+def get_cfg_human(backbone='R101'):
+    config,weights = HUMAN_CONFIGS[backbone]
+    cfg_human = get_cfg()
+    cfg_human.merge_from_file(model_zoo.get_config_file(config))
+    cfg_human.MODEL.WEIGHTS = weights if weights is not None else model_zoo.get_checkpoint_url(config)
+    return cfg_human
+
+def get_human_model(nms_thres=0.0,score_thres=0.995,batch=False,keypoints=False,backbone='R101',max_dets=100,
+        backend='eager',quantize=False,min_size=None,max_size=None):
+    '''
+    Person predictor, built on first use and cached by its settings.
+    - keypoints (bool, default: False): also run the keypoint head. Nothing uses pred_keypoints, and the boxes are the same without it
+    - backbone (string, default: 'R101'): one of HUMAN_CONFIGS, 'R50' is lighter
+    - max_dets (int, default: 100): most detections kept per image, after NMS
+    - backend, quantize: CPU optimisations, see optimise_model
+    - min_size, max_size: test resize, see set_test_size
+    The box head only knows the person class, so every output is a person.
+    '''
+    def make_cfg():
+        cfg_human = get_cfg_human(backbone).clone()
+        cfg_human.MODEL.KEYPOINT_ON = keypoints
+        cfg_human.MODEL.ROI_HEADS.NMS_THRESH_TEST = nms_thres #IoU aka overlap suppression (suppress if overlap > threshold)
+        cfg_human.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_thres #this isnt a confidence score filter... but seems to correlate well anyways
+        cfg_human.TEST.DETECTIONS_PER_IMAGE = max_dets
+        return set_test_size(cfg_human,min_size,max_size)
+    return cached_predictor(('human',nms_thres,score_thres,batch,keypoints,backbone,max_dets,backend,quantize,min_size,max_size),
+        make_cfg,batch,backend,quantize)
+
+
+#The clothes model can't share the person model's backbone: the two checkpoints have separately trained R101-FPNs,
+#so the garment ROI head only makes sense on features from its own backbone. Sharing one forward pass would need the
+#garment head fine-tuned on the keypoint R-CNN's features first. Until then check_doll saves the person pass instead (MotionGate).
+@lru_cache(maxsize=None)
+def get_cfg_clothes():
+    cfg_clothes = get_cfg()
+    cfg_clothes.merge_from_file(model_zoo.get_config_file("COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml"))
+    cfg_clothes.MODEL.WEIGHTS = str(clothes_model_path)
+    cfg_clothes.MODEL.ROI_HEADS.NUM_CLASSES = 5
+    return cfg_clothes
+
+@lru_cache(maxsize=None)
+def get_metadata():
+    '''Clothes class names straight from categories.json, in the same (sorted id) order the COCO loader gives them.'''
+    with open(categories_json) as f: cats = sorted(json.load(f)['categories'],key=lambda c:c['id'])
+    metadata = MetadataCatalog.get("categories")
+    metadata.set(thing_classes=[c['name'] for c in cats],thing_dataset_id_to_contiguous_id={c['id']:i for i,c in enumerate(cats)})
+    return metadata
+
+def id_to_label(ids):
+    thing_classes = get_metadata().thing_classes
+    return [thing_classes[id] for id in ids]
+
+def get_clothes_model(nms_thres=0.2,score_thres=0.6,batch=False,max_dets=100,backend='eager',quantize=False,min_size=None,max_size=None):
+    '''Clothes predictor, built on first use and cached by its settings (the rest as in get_human_model).'''
+    def make_cfg():
+        cfg_clothes = get_cfg_clothes().clone()
+        cfg_clothes.MODEL.ROI_HEADS.NMS_THRESH_TEST = nms_thres
+        cfg_clothes.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_thres
+        cfg_clothes.TEST.DETECTIONS_PER_IMAGE = max_dets
+        return set_test_size(cfg_clothes,min_size,max_size)
+    return cached_predictor(('clothes',nms_thres,score_thres,batch,max_dets,backend,quantize,min_size,max_size),make_cfg,batch,backend,quantize)
 
 def display(im):
     cv2.namedWindow('Model Prediction', cv2.WINDOW_NORMAL)
@@ -56,21 +255,37 @@ def display(im):
     cv2.destroyAllWindows()
 
 def visualize(im,outputs):
-    v = Visualizer(im, metadata, scale=1)
+    v = Visualizer(im, get_metadata(), scale=1)
     v = v.draw_instance_predictions(outputs["instances"].to("cpu"))
     im_out = v.get_image()
     return im_out
 
+def best_index(instances,min_area,max_area):
+    '''Index of the highest scoring detection with min_area < area < max_area, or None. Stays in tensor ops.'''
+    if len(instances) == 0: return None
+    areas = instances.pred_boxes.area()
+    scores = instances.scores.masked_fill(~((areas > min_area)&(areas < max_area)),-1.0)
+    i = int(scores.argmax())
+    return i if scores[i] >= 0 else None
+
 def get_most_confident(outputs,min_area,max_area):
-    if len(outputs["instances"]) == 0: return []
-    outputs = outputs["instances"].to("cpu")
-    areas = outputs.pred_boxes.area().tolist()
-    bybest = sorted([(i,s) for i,s in enumerate(outputs.scores.tolist())
-            if min_area<areas[i] and areas[i]<max_area],
-        key=lambda x:x[1],
-        reverse=True)
-    if len(bybest) == 0: return []
-    return outputs[bybest[0][0]].pred_boxes
+    i = best_index(outputs["instances"],min_area,max_area)
+    if i is None: return []
+    return outputs["instances"].pred_boxes[i].to("cpu")
+
+def locate_person(outputs,min_area=0,max_area=100000):
+    '''Returns (box, area, centre) of the most confident person within the area limits, or (None, None, None).'''
+    instances = outputs["instances"]
+    i = best_index(instances,min_area,max_area)
+    if i is None: return None,None,None
+    x1,y1,x2,y2 = instances.pred_boxes.tensor[i].tolist() #the only copy out of the tensor
+    return [x1,y1,x2,y2],(x2-x1)*(y2-y1),[(x1+x2)/2.0,(y1+y2)/2.0]
+
+def class_scores(outputs,num_classes):
+    '''Sum of detection scores per class as a numpy array of num_classes, eg. to add up evidence over snaps.'''
+    instances = outputs["instances"]
+    sums = torch.zeros(num_classes,dtype=instances.scores.dtype,device=instances.scores.device)
+    return sums.index_add_(0,instances.pred_classes,instances.scores).cpu().numpy()
 
 def crop_bbox(im,bbox,b=0.1):
     x1,y1,x2,y2 = bbox
@@ -79,6 +294,191 @@ def crop_bbox(im,bbox,b=0.1):
     x1,y1,x2,y2 = round(max(0,x1-xf)),round(max(0,y1-yf)),round(min(w,x2+xf)),round(min(h,y2+yf))
     return im[y1:y2,x1:x2],(x1,y1)
 
+class MotionGate:
+    '''
+    Reuses the last inference result while the scene hasn't meaningfully changed, eg. for the stationary confirmation snaps.
+    Frames are compared to the frame the cached result came from on a small grayscale thumbnail (mean absolute difference, 0-255),
+    so slow drift still adds up to a miss.
+    - threshold (number, default: 3.0): change score under which the cached result is reused
+    - size (tuple, default: (64,36)): thumbnail size
+    - min_fresh (float, default: 0.0): fraction of results since reset_stats() that must come from fresh inference, can be overridden per lookup
+    '''
+    def __init__(self,threshold=3.0,size=(64,36),min_fresh=0.0):
+        self.threshold = threshold
+        self.size = size
+        self.min_fresh = min_fresh
+        self.ref = None
+        self.result = None
+        self.hits = self.misses = 0 #since the gate was made
+        self.reset_stats()
+
+    def reset_stats(self):
+        '''Start counting toward min_fresh again, eg. at the start of each check.'''
+        self.window_hits = self.window_misses = 0
+
+    def thumbnail(self,im):
+        return cv2.cvtColor(cv2.resize(im,self.size,interpolation=cv2.INTER_AREA),cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+    def change(self,thumb):
+        '''Change score of a thumbnail vs the cached result's frame, inf if there is none.'''
+        if self.ref is None: return float('inf')
+        return float(np.abs(thumb-self.ref).mean())
+
+    def lookup(self,im,min_fresh=None):
+        '''
+        Returns (result, key). result is the cached one if im looks like the reference frame, otherwise None,
+        and the caller runs the model and hands the result back with store(key, result).
+        - min_fresh (float, default: None): overrides the gate's min_fresh for this call
+        '''
+        min_fresh = self.min_fresh if min_fresh is None else min_fresh
+        thumb = self.thumbnail(im)
+        total = self.window_hits+self.window_misses+1
+        if self.change(thumb) < self.threshold and self.window_misses >= min_fresh*total:
+            self.hits += 1
+            self.window_hits += 1
+            return self.result,None
+        self.misses += 1
+        self.window_misses += 1
+        return None,thumb
+
+    def store(self,key,result):
+        self.ref,self.result = key,result
+
+    def __call__(self,im,compute,min_fresh=None):
+        '''Cached result for im, or compute(im) if the scene changed.'''
+        result,key = self.lookup(im,min_fresh)
+        if key is None: return result
+        result = compute(im)
+        self.store(key,result)
+        return result
+
+class _Pending:
+    '''Stands in for the result of a batch item that is still being computed.'''
+    def __init__(self,index): self.index = index
+
+def gated_predict(model,images,gate=None,min_fresh=None):
+    '''
+    predict_many, except images the MotionGate says are unchanged reuse a cached result. Returns (outputs, cached flags).
+    Within a batch, a frame that looks like an earlier miss in the same batch reuses that miss's result.
+    '''
+    if gate is None: return predict_many(model,images),[False]*len(images)
+    outputs,cached,todo = [None]*len(images),[True]*len(images),[]
+    for i,im in enumerate(images):
+        result,key = gate.lookup(im,min_fresh)
+        if key is None:
+            outputs[i] = result
+            continue
+        gate.store(key,_Pending(i)) #later frames in the batch compare against this one
+        cached[i] = False
+        todo.append(i)
+    for i,o in zip(todo,predict_many(model,[images[i] for i in todo])): outputs[i] = o
+    outputs = [outputs[o.index] if isinstance(o,_Pending) else o for o in outputs]
+    if isinstance(gate.result,_Pending): gate.result = outputs[gate.result.index]
+    return outputs,cached
+
+PipelineResult = namedtuple('PipelineResult',['seq','stamp','im','human_outputs','box','box_area','box_centre','crop','offset','clothes_outputs','human_cached','clothes_cached','clothes_scores'],
+    defaults=(False,False,None))
+
+class DetectionPipeline:
+    '''
+    Runs decode, person detection, cropping & garment detection each in its own worker, with bounded queues in between.
+    The clothes model on frame N overlaps the human model on frame N+1. Results come out in frame order, tagged with the frame's sequence number.
+    - source (callable): source(after_seq) -> (seq, timestamp, frame), frame is None if nothing arrived (eg. Robot.wait_frame)
+    - human_model (callable): person predictor, see get_human_model
+    - clothes_model (callable): garment predictor, see get_clothes_model
+    - min_area, max_area (number): person box area limits, see locate_person
+    - margin (float, default: 0.1): extra margin around the person crop, see crop_bbox
+    - after_seq (int, default: -1): only frames newer than this are processed
+    - queue_size (int, default: 2): capacity of each queue between stages
+    - batch_size (int, default: 1): max frames a model stage takes at once, only batches in one forward pass with BatchPredictor models
+    - human_gate, clothes_gate (MotionGate, default: None): reuse person boxes / garment detections while the scene is unchanged
+    - min_fresh (float, default: None): fraction of gated results that must come from fresh inference, None uses the gates' own
+    '''
+    def __init__(self,source,human_model,clothes_model,min_area=0,max_area=100000,margin=0.1,after_seq=-1,queue_size=2,batch_size=1,
+            human_gate=None,clothes_gate=None,min_fresh=None):
+        self.source = source
+        self.human_model = human_model
+        self.clothes_model = clothes_model
+        self.min_area,self.max_area = min_area,max_area
+        self.margin = margin
+        self.after_seq = after_seq
+        self.batch_size = batch_size
+        self.human_gate,self.clothes_gate = human_gate,clothes_gate
+        self.min_fresh = min_fresh
+        self.queues = [Queue(max(queue_size,batch_size)) for _ in range(4)] #decode->person->crop->clothes->results
+        self.stopped = Event()
+        self.error = None
+        self.threads = [
+            Thread(target=self.__decode,daemon=True),
+            Thread(target=self.__stage,args=(self.__person,self.queues[0],self.queues[1]),daemon=True),
+            Thread(target=self.__stage,args=(self.__crop,self.queues[1],self.queues[2]),daemon=True),
+            Thread(target=self.__stage,args=(self.__clothes,self.queues[2],self.queues[3]),daemon=True)]
+
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def start(self):
+        for t in self.threads: t.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for t in self.threads: t.join()
+
+    def get(self,timeout=None):
+        '''Next PipelineResult in frame order, None on timeout. Re-raises any error from the workers.'''
+        try: return self.queues[-1].get(timeout=timeout)
+        except Empty:
+            if self.error is not None: raise self.error
+            return None
+
+    def __put(self,q,item):
+        while not self.stopped.is_set():
+            try: return q.put(item,timeout=0.1)
+            except Full: pass
+
+    def __decode(self):
+        seq = self.after_seq
+        while not self.stopped.is_set():
+            seq,stamp,im = self.source(seq)
+            if im is None: continue
+            self.__put(self.queues[0],PipelineResult(seq,stamp,im,None,None,None,None,None,None,None))
+
+    def __stage(self,fn,q_in,q_out):
+        '''Takes whatever is queued (up to batch_size, at least 1) and passes the list through fn.'''
+        try:
+            while not self.stopped.is_set():
+                try: items = [q_in.get(timeout=0.1)]
+                except Empty: continue
+                while len(items) < self.batch_size:
+                    try: items.append(q_in.get_nowait())
+                    except Empty: break
+                for item in fn(items): self.__put(q_out,item)
+        except Exception as e:
+            self.error = e
+            self.stopped.set()
+
+    def __person(self,rs):
+        outputs,cached = gated_predict(self.human_model,[r.im for r in rs],self.human_gate,self.min_fresh)
+        for i,o in enumerate(outputs):
+            box,box_area,box_centre = locate_person(o,self.min_area,self.max_area)
+            rs[i] = rs[i]._replace(human_outputs=o,box=box,box_area=box_area,box_centre=box_centre,human_cached=cached[i])
+        return rs
+
+    def __crop(self,rs):
+        for i,r in enumerate(rs):
+            if r.box is None: continue
+            crop,offset = crop_bbox(r.im,r.box,b=self.margin)
+            rs[i] = r._replace(crop=crop,offset=offset)
+        return rs
+
+    def __clothes(self,rs):
+        todo = [i for i,r in enumerate(rs) if r.crop is not None]
+        outputs,cached = gated_predict(self.clothes_model,[rs[i].crop for i in todo],self.clothes_gate,self.min_fresh)
+        num_classes = len(get_metadata().thing_classes)
+        for i,o,c in zip(todo,outputs,cached): rs[i] = rs[i]._replace(clothes_outputs=o,clothes_cached=c,clothes_scores=class_scores(o,num_classes))
+        return rs
+
 if __name__ == "__main__":
     im = cv2.imread("./unnamed.png")
     human_model = get_human_model()
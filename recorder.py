@@ -0,0 +1,263 @@
+'''
+Session recorder, so field runs can be replayed & analysed offline.
+A session is a directory of segments, each an append-only data file (.dat) with a fixed-size record index (.idx) next to it.
+The index holds each record's timestamp, kind & where its bytes are, so Session can memory-map the segments and
+jump to any frame by number or time without reading the rest.
+
+recorder = Recorder('runs/field1',jpeg_quality=90).start()
+with Robot(recorder=recorder) as robot: ...   #frames, commands, replies & pose pushes
+recorder.detections(seq,'human',outputs,stamp) #detector results of frame seq
+recorder.stop()
+
+session = Session('runs/field1')
+seq,stamp,im = session.frame_at(session.start+12.5)
+for im in read_frames('runs/field1'): ...      #or an image glob or a video file
+'''
+import glob
+import json
+import os
+from itertools import islice
+from queue import Queue, Full
+from threading import Thread
+from time import time
+import numpy as np
+import cv2
+
+FRAME,COMMAND,REPLY,POSE,DETECTIONS = range(5) #record kinds
+RAW,JPEG = range(2) #frame codecs
+INDEX_DTYPE = np.dtype([('stamp','<f8'),('kind','u1'),('codec','u1'),('tag','<u2'),('seq','<i8'),('offset','<u8'),('length','<u4'),
+    ('h','<u2'),('w','<u2'),('c','u1')]) #tag is the detections' name (index into session.json's tags)
+SEGMENT_BYTES = 256*1024*1024 #data bytes per segment before starting a new one
+QUEUE_SIZE = 64 #records waiting to be written, frames are dropped beyond it
+RECORD_ROOM = 1024 #extra queue room only text, poses & detections may use, they are dropped beyond it
+
+def detections_array(outputs,offset=(0,0)):
+    '''(n,6) float32 of x1,y1,x2,y2,score,class from {'instances': Instances}, Instances or such an array already.'''
+    if isinstance(outputs,np.ndarray): return outputs.astype(np.float32,copy=False)
+    instances = outputs['instances'] if isinstance(outputs,dict) else outputs
+    instances = instances.to('cpu')
+    boxes = instances.pred_boxes.tensor.numpy()+np.array(offset*2,np.float32)
+    classes = instances.pred_classes.numpy() if instances.has('pred_classes') else np.zeros(len(instances))
+    return np.column_stack([boxes,instances.scores.numpy(),classes]).astype(np.float32)
+
+class Recorder:
+    '''
+    Writes a session from a background thread. Every call only queues & never blocks, so the robot's threads can call it.
+    Frames are dropped (counted in dropped) once queue_size records wait, text, poses & detections have record_room more
+    before they are dropped too (counted in dropped_records).
+    - path (string): session directory, created if missing
+    - jpeg_quality (int, default: None): store frames as JPEG of this quality, None stores them raw
+    - segment_bytes (int, default: SEGMENT_BYTES): data bytes per segment file
+    - queue_size (int, default: QUEUE_SIZE): records waiting to be written before frames are dropped
+    - record_room (int, default: RECORD_ROOM): extra records only small ones may fill
+    '''
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def __init__(self,path,jpeg_quality=None,segment_bytes=SEGMENT_BYTES,queue_size=QUEUE_SIZE,record_room=RECORD_ROOM):
+        self.path = path
+        self.jpeg_quality = jpeg_quality
+        self.segment_bytes = segment_bytes
+        self.queue_size = queue_size
+        self.queue = Queue(queue_size+record_room)
+        self.tags = [] #detection names, position is the index's tag
+        self.segment = -1
+        self.dat = self.idx = None
+        self.written = 0 #records written
+        self.dropped = 0 #frames dropped because the writer fell behind
+        self.dropped_records = 0 #text, poses & detections dropped because it fell far behind
+        self.thread = Thread(target=self.__run,daemon=True)
+
+    def start(self):
+        os.makedirs(self.path,exist_ok=True)
+        self.__write_meta()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Writes everything still queued & closes the files.'''
+        self.queue.put(None)
+        self.thread.join()
+
+    def frame(self,im,stamp=None,seq=-1):
+        '''Queue a frame. im is copied, so ring buffer frames can be passed straight in.'''
+        if self.queue.qsize() >= self.queue_size: #leave the rest of the room to small records
+            self.dropped += 1
+            return
+        try: self.queue.put_nowait((FRAME,time() if stamp is None else stamp,seq,im.copy()))
+        except Full: self.dropped += 1
+
+    def __put(self,record):
+        try: self.queue.put_nowait(record)
+        except Full: self.dropped_records += 1
+
+    def command(self,text,stamp=None): self.__put((COMMAND,time() if stamp is None else stamp,-1,text))
+    def reply(self,text,stamp=None): self.__put((REPLY,time() if stamp is None else stamp,-1,text))
+
+    def pose(self,t,x,y,pitch,roll,yaw): self.__put((POSE,t,-1,np.array([x,y,pitch,roll,yaw],np.float64)))
+
+    def detections(self,seq,name,outputs,stamp=None,offset=(0,0)):
+        '''
+        Queue detector results for frame seq.
+        - name (string): which detector, eg. 'human' or 'clothes'
+        - outputs: {'instances': Instances}, Instances or an (n,6) array, see detections_array
+        - offset (tuple, default: (0,0)): added to the boxes, eg. a crop's offset so they are in frame coordinates
+        '''
+        self.__put((DETECTIONS,time() if stamp is None else stamp,seq,(name,detections_array(outputs,offset))))
+
+    def __write_meta(self):
+        with open(os.path.join(self.path,'session.json'),'w') as f: json.dump({'tags':self.tags,'segment_bytes':self.segment_bytes},f)
+
+    def __open_segment(self):
+        for f in (self.dat,self.idx):
+            if f is not None: f.close()
+        self.segment += 1
+        name = os.path.join(self.path,f'{self.segment:05d}')
+        self.dat,self.idx = open(name+'.dat','wb'),open(name+'.idx','wb')
+        self.offset = 0
+
+    def __encode(self,kind,payload):
+        '''(codec, tag, shape, bytes) of one record.'''
+        if kind == FRAME:
+            h,w = payload.shape[:2]
+            c = payload.shape[2] if payload.ndim == 3 else 1
+            if self.jpeg_quality is None: return RAW,0,(h,w,c),payload.tobytes()
+            ok,buf = cv2.imencode('.jpg',payload,[cv2.IMWRITE_JPEG_QUALITY,self.jpeg_quality])
+            return JPEG,0,(h,w,c),buf.tobytes()
+        if kind == DETECTIONS:
+            name,dets = payload
+            if name not in self.tags:
+                self.tags.append(name)
+                self.__write_meta()
+            return RAW,self.tags.index(name),(len(dets),6,0),dets.tobytes()
+        if kind == POSE: return RAW,0,(0,0,0),payload.tobytes()
+        return RAW,0,(0,0,0),payload.encode('utf8')
+
+    def __run(self):
+        self.__open_segment()
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            kind,stamp,seq,payload = item
+            codec,tag,(h,w,c),data = self.__encode(kind,payload)
+            if self.offset and self.offset+len(data) > self.segment_bytes: self.__open_segment()
+            self.dat.write(data)
+            self.idx.write(np.array([(stamp,kind,codec,tag,seq,self.offset,len(data),h,w,c)],INDEX_DTYPE).tobytes())
+            self.offset += len(data)
+            self.written += 1
+            if self.queue.empty(): #flush when idle, so a crash loses little
+                self.dat.flush()
+                self.idx.flush()
+        self.dat.close()
+        self.idx.close()
+
+class Session:
+    '''
+    Reads a recorded session. Segments are memory-mapped & only the records asked for are read (raw frames are zero copy views).
+    Frames are numbered in recording order, n-th frame != robot seq if frames were dropped.
+    '''
+    def __init__(self,path):
+        self.path = path
+        with open(os.path.join(path,'session.json')) as f: self.tags = json.load(f)['tags']
+        names = sorted(f[:-4] for f in os.listdir(path) if f.endswith('.idx'))
+        self.data = []
+        indexes = []
+        for seg,name in enumerate(names):
+            dat = os.path.join(path,name+'.dat')
+            self.data.append(np.memmap(dat,np.uint8,'r') if os.path.getsize(dat) else np.zeros(0,np.uint8))
+            raw = np.fromfile(os.path.join(path,name+'.idx'),np.uint8)
+            index = raw[:len(raw)//INDEX_DTYPE.itemsize*INDEX_DTYPE.itemsize].view(INDEX_DTYPE) #drop a half written record
+            indexes.append((index,np.full(len(index),seg,np.int32)))
+        self.index = np.concatenate([i for i,_ in indexes]) if indexes else np.zeros(0,INDEX_DTYPE)
+        self.segments = np.concatenate([s for _,s in indexes]) if indexes else np.zeros(0,np.int32)
+        self.frame_rows = np.nonzero(self.index['kind'] == FRAME)[0]
+        self.frame_stamps = self.index['stamp'][self.frame_rows]
+
+    def __len__(self): return len(self.frame_rows)
+
+    @property
+    def start(self): return float(self.index['stamp'].min()) if len(self.index) else None
+    @property
+    def end(self): return float(self.index['stamp'].max()) if len(self.index) else None
+
+    def __bytes(self,row):
+        r = self.index[row]
+        return self.data[self.segments[row]][int(r['offset']):int(r['offset'])+int(r['length'])]
+
+    def frame(self,n):
+        '''(seq, timestamp, frame) of the n-th recorded frame.'''
+        row = self.frame_rows[n]
+        r = self.index[row]
+        buf = self.__bytes(row)
+        if r['codec'] == JPEG: im = cv2.imdecode(np.asarray(buf),cv2.IMREAD_UNCHANGED)
+        else: im = buf.reshape((r['h'],r['w'],r['c']) if r['c'] > 1 else (r['h'],r['w']))
+        return int(r['seq']),float(r['stamp']),im
+
+    def frame_index(self,t):
+        '''Number of the newest frame at or before time t (the first frame if t is earlier).'''
+        return max(0,int(np.searchsorted(self.frame_stamps,t,side='right'))-1)
+
+    def frame_at(self,t):
+        '''(seq, timestamp, frame) of the newest frame at or before time t.'''
+        return self.frame(self.frame_index(t))
+
+    def iter_frames(self,start=None,end=None):
+        '''Yields (seq, timestamp, frame) for frames with start <= timestamp < end, one at a time.'''
+        lo = 0 if start is None else int(np.searchsorted(self.frame_stamps,start))
+        hi = len(self) if end is None else int(np.searchsorted(self.frame_stamps,end))
+        for n in range(lo,hi): yield self.frame(n)
+
+    def __rows(self,kind,start,end):
+        rows = np.nonzero(self.index['kind'] == kind)[0]
+        stamps = self.index['stamp'][rows]
+        keep = np.ones(len(rows),bool)
+        if start is not None: keep &= stamps >= start
+        if end is not None: keep &= stamps < end
+        return rows[keep]
+
+    def commands(self,start=None,end=None):
+        '''[(timestamp, command)] sent between start & end.'''
+        return [(float(self.index['stamp'][r]),bytes(self.__bytes(r)).decode('utf8')) for r in self.__rows(COMMAND,start,end)]
+
+    def replies(self,start=None,end=None):
+        '''[(timestamp, reply)] received between start & end.'''
+        return [(float(self.index['stamp'][r]),bytes(self.__bytes(r)).decode('utf8')) for r in self.__rows(REPLY,start,end)]
+
+    def poses(self,start=None,end=None):
+        '''(n,6) array of t, x, y, pitch, roll, yaw, like PoseHistory.history().'''
+        rows = self.__rows(POSE,start,end)
+        if len(rows) == 0: return np.zeros((0,6))
+        return np.column_stack([self.index['stamp'][rows],np.stack([self.__bytes(r).view(np.float64) for r in rows])])
+
+    def detections(self,seq,name):
+        '''(n,6) array of x1,y1,x2,y2,score,class that detector name gave for frame seq, None if it wasn't recorded.'''
+        if name not in self.tags: return None
+        rows = np.nonzero((self.index['kind'] == DETECTIONS)&(self.index['seq'] == seq)&(self.index['tag'] == self.tags.index(name)))[0]
+        if len(rows) == 0: return None
+        return self.__bytes(rows[-1]).view(np.float32).reshape(-1,6)
+
+def read_frames(source,limit=None,repeat=False):
+    '''
+    Yields the frames of a recorded session directory, an image glob (sorted) or a video file, one at a time.
+    Reading happens inside the generator, so time spent in next() is the decode cost.
+    - limit (int, default: None): most frames yielded, None for all
+    - repeat (bool, default: False): cycle through the images of a glob (or a single image) until limit
+    '''
+    if os.path.isdir(source):
+        frames = (im for _,_,im in Session(source).iter_frames())
+    else:
+        files = sorted(glob.glob(source))
+        if len(files) > 1 or (files and cv2.haveImageReader(files[0])):
+            if repeat and limit is None: raise ValueError('repeating images needs a limit')
+            frames = (cv2.imread(files[i%len(files)]) for i in range(limit if repeat else len(files)))
+        else: frames = _video_frames(source)
+    yield from islice(frames,limit)
+
+def _video_frames(path):
+    cap = cv2.VideoCapture(path)
+    try:
+        while True:
+            ok,im = cap.read()
+            if not ok: return
+            yield im
+    finally: cap.release()
@@ -1,8 +1,12 @@
 #Adapted from https://github.com/dji-sdk/RoboMaster-SDK/tree/master/sample_code/RoboMasterEP
 import socket
+import select
 import cv2
-from threading import Thread
-from time import sleep
+import numpy as np
+from threading import Thread, Condition, Lock, Event
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from time import sleep, time
 
 VIDEO_PORT = 40921
 AUDIO_PORT = 40922
@@ -14,10 +18,20 @@ IP_PORT = 40926
 SPD_LIMIT = 0.3
 TURN_LIMIT = 10
 BUFFER_TIME = 0.5 #in seconds
+ACK_TIMEOUT = 5.0 #in seconds, extra time given to acknowledgements on top of the estimated action time
+REPLY_IDLE = 0.05 #in seconds, quiet time after which a reply without a trailing ; counts as complete
+FRAME_SLOTS = 4 #frames kept in the ring buffer
+POSE_SLOTS = 1024 #pose pushes kept in the history
+PUSH_FREQS = (1,5,10,20,30,50) #push rates the SDK accepts, in Hz
+JITTER_SLOTS = 1000 #loop ticks kept for the ControlLoop jitter stats
+STREAM_TIMEOUT = 10.0 #in seconds, how long to keep trying to open the video stream
 
 def calculate_move_time(x,y,spd): return (x**2+y**2)**0.5/float(spd)
 def calculate_turn_time(ang,spd): return abs(float(ang)/spd)
 
+class CommandError(Exception):
+    '''The robot replied to a command with something other than ok.'''
+
 def find_robot_ip(timeout=None):
     '''Finds the IP address broadcasted by the robot'''
     with socket.socket(socket.AF_INET,socket.SOCK_DGRAM) as s:
@@ -27,16 +41,145 @@ def find_robot_ip(timeout=None):
         print(f'UDP Broadcast from {addr}: {data}')
         return addr[0]
 
+class FrameBuffer:
+    '''
+    Preallocated ring of video frames with sequence numbers & capture timestamps.
+    The decoder writes into the oldest slot while consumers read the newest, so a published frame stays valid for (slots-1) more frames.
+    - slots (int, default: FRAME_SLOTS): number of frames kept, at least 2
+    '''
+    def __init__(self,slots=FRAME_SLOTS):
+        assert slots >= 2
+        self.slots = slots
+        self.buf = None #allocated on first frame, once the stream's shape is known
+        self.seqs = [-1]*slots
+        self.stamps = [0.0]*slots
+        self.seq = -1 #last published sequence number
+        self.dropped = 0 #frames published while a consumer was waiting for them but skipped, idle time between waits doesn't count
+        self.closed = False
+        self.cond = Condition()
+
+    def write_slot(self):
+        '''Array the next frame can be decoded into in-place (None until the first frame arrives).'''
+        if self.buf is None: return None
+        return self.buf[(self.seq+1)%self.slots]
+
+    def publish(self,frame,stamp=None):
+        '''Publish a decoded frame. Copies only if it wasn't decoded into write_slot().'''
+        stamp = time() if stamp is None else stamp
+        idx = (self.seq+1)%self.slots
+        if self.buf is None or self.buf.shape[1:] != frame.shape or self.buf.dtype != frame.dtype:
+            with self.cond: #resolution changed, readers must not see a half swapped buffer
+                self.buf = np.empty((self.slots,)+frame.shape,dtype=frame.dtype)
+                self.seqs = [-1]*self.slots
+        slot = self.buf[idx]
+        if frame is not slot and not np.may_share_memory(frame,slot): np.copyto(slot,frame)
+        with self.cond:
+            self.seqs[idx] = self.seq+1
+            self.stamps[idx] = stamp
+            self.seq += 1
+            self.cond.notify_all()
+
+    def _take(self,copy):
+        '''Newest frame, call with cond held.'''
+        idx = self.seq%self.slots
+        frame = self.buf[idx].copy() if copy else self.buf[idx]
+        return self.seq,self.stamps[idx],frame
+
+    def latest(self,copy=False):
+        '''Returns (seq, timestamp, frame) of the newest frame, or (-1, None, None) if there is none yet. Zero copy by default.'''
+        with self.cond:
+            if self.seq < 0: return -1,None,None
+            return self._take(copy)
+
+    def wait(self,after_seq=-1,timeout=None,copy=True):
+        '''
+        Block until a frame newer than after_seq is published. Returns (seq, timestamp, frame), or (after_seq, None, None) on timeout or once closed.
+        - after_seq (int, default: -1): sequence number of the last frame the caller has seen
+        - timeout (number, default: None): seconds to wait, None waits forever
+        - copy (bool, default: True): return a private copy, use False only if done with the frame within (slots-1) frames
+        '''
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > after_seq or self.closed,timeout): return after_seq,None,None
+            if self.seq <= after_seq: return after_seq,None,None
+            if after_seq >= 0: self.dropped += self.seq-after_seq-1 #frames this consumer skipped since its last one
+            return self._take(copy)
+
+    def close(self):
+        '''Wake up all waiting consumers, they get no frame from now on.'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class PoseHistory:
+    '''
+    Preallocated ring of timestamped chassis poses, one row per push: (t, x, y, pitch, roll, yaw). Metres and degrees.
+    Only the push thread writes, readers never lock: a row is complete before count moves past it, and reads skip the row being overwritten.
+    - slots (int, default: POSE_SLOTS): number of poses kept
+    '''
+    T,X,Y,PITCH,ROLL,YAW = range(6)
+
+    def __init__(self,slots=POSE_SLOTS):
+        self.slots = slots
+        self.data = np.zeros((slots,6))
+        self.count = 0
+
+    def append(self,t,x,y,pitch,roll,yaw):
+        self.data[self.count%self.slots] = (t,x,y,pitch,roll,yaw)
+        self.count += 1
+
+    def latest_pose(self):
+        '''Newest row as a copy, or None if nothing was pushed yet.'''
+        n = self.count
+        if n == 0: return None
+        return self.data[(n-1)%self.slots].copy()
+
+    def history(self):
+        '''All rows (except the one about to be overwritten) in time order, as a copy.'''
+        n = self.count
+        if n < self.slots: return self.data[:n].copy()
+        i = n%self.slots #next row to be written
+        return np.concatenate((self.data[i+1:],self.data[:i]))
+
+    def pose_at(self,t):
+        '''Pose at time t, linearly interpolated between pushes (clamped to the oldest/newest). None if nothing was pushed yet.'''
+        rows = self.history()
+        if len(rows) == 0: return None
+        ts = rows[:,self.T]
+        pose = np.array([t]+[np.interp(t,ts,rows[:,c]) for c in (self.X,self.Y,self.PITCH,self.ROLL)]+[0.0])
+        yaw = np.degrees(np.unwrap(np.radians(rows[:,self.YAW]))) #so 179 -> -179 interpolates through 180, not 0
+        pose[self.YAW] = (np.interp(t,ts,yaw)+180.0)%360.0-180.0
+        return pose
+
+def parse_push(text):
+    '''Parses a chassis push message into {attribute: [values]}, eg. {'position': [x, y], 'attitude': [pitch, roll, yaw]}.'''
+    tokens = text.replace(';',' ').split()
+    if tokens[:2] != ['chassis','push']: return {}
+    data,key = {},None
+    for tok in tokens[2:]:
+        try: data[key].append(float(tok))
+        except (ValueError,KeyError):
+            key = tok
+            data[key] = []
+    return data
+
 class Robot:
     '''Class to wrap around robot's text based SDK. +x is forwards, +y is right.'''
     def __enter__(self): return self.open()
     def __exit__(self,exc_type,exc_val,exc_tb): self.close()
     
-    def __init__(self,robot_ip=None):
+    def __init__(self,robot_ip=None,frame_slots=FRAME_SLOTS,push_freq=5,pose_slots=POSE_SLOTS,max_fps=None,frame_size=None,stream_timeout=STREAM_TIMEOUT,recorder=None):
         '''
         Connects to the robot & initializes services.
         - robot_ip (string, default: None): IP to connect to, if None will look for robot's broadcast.
+        - frame_slots (int, default: FRAME_SLOTS): size of the video frame ring buffer
+        - push_freq (int, default: 5): chassis position/attitude push rate in Hz, one of PUSH_FREQS
+        - pose_slots (int, default: POSE_SLOTS): size of the pose history
+        - max_fps (number, default: None): frames per second published to consumers, the rest are only grabbed, not retrieved. None publishes all (~30)
+        - frame_size (tuple, default: None): (w,h) to downscale frames to as they are decoded, None keeps 720p. The task scripts' pixel thresholds assume 720p
+        - stream_timeout (number, default: STREAM_TIMEOUT): seconds to keep trying to open the video stream
+        - recorder (Recorder, default: None): started recorder.Recorder that gets the frames, commands, replies & pose pushes
         '''
+        if push_freq not in PUSH_FREQS: raise ValueError(f'push_freq must be one of {PUSH_FREQS}')
         self.ip = find_robot_ip() if robot_ip is None else robot_ip
 
         #self.audio_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -45,23 +188,35 @@ class Robot:
         #self.event_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         self.isOpen = False
-        self.frame = None
-        self.hasNewFrame = False
+        self.frames = FrameBuffer(frame_slots)
         self.stream = None
-        self.pos = [0,0,0]
+        self.max_fps = max_fps
+        self.frame_size = frame_size
+        self.stream_timeout = stream_timeout
+        self.recorder = recorder
+        self.grabbed = 0 #frames read off the stream
+        self.decoded = 0 #frames retrieved & published
+        self.skipped = 0 #frames only grabbed because max_fps didn't need them
+        self.decode_time = 0.0 #seconds spent retrieving (& resizing) the published frames
+        self.latency = 0.0 #seconds from grab returning to publish, summed over the published frames
+        self.push_freq = push_freq
+        self.poses = PoseHistory(pose_slots)
+        self.pending = deque() #(command, Future) waiting for a reply, the SDK replies in order
+        self.send_lock = Lock()
 
     def open(self):
         self.cmd_feedback_thread = Thread(target=self.__recvmsg)
         self.vid_receive_thread = Thread(target=self.__recvvideo,daemon=True)
-        self.push_thread = Thread(target=self.__recvpush)
+        self.push_thread = Thread(target=self.__recvpush,daemon=True)
         self.isOpen = True
 
         try:
             self.ctrl_sock.connect((self.ip,CTRL_PORT))
             self.cmd_feedback_thread.start()
             self.send('command')
-            self.push_sock.connect((self.ip,PUSH_PORT))
-            #self.push_thread.start()
+            self.push_sock.bind(('',PUSH_PORT)) #the robot sends pushes to this port on our side
+            self.push_sock.settimeout(0.5)
+            self.push_thread.start()
             self.vid_receive_thread.start()
         except Exception as e:
             self.close()
@@ -77,51 +232,197 @@ class Robot:
         except:
             pass
         self.isOpen = False
+        self.frames.close()
         try:
             self.ctrl_sock.close()
+            self.push_sock.close()
             self.stream.release()
         except:
             pass
+        self.__fail_pending(ConnectionError('robot closed'))
         #self.cmd_feedback_thread.join()
         #self.vid_receive_thread.join()
         #self.push_thread.join()
         print(f"Disconnected from {self.ip}")
     
     def send(self,*args):
-        '''Send commands directly! If there is multiple args it will join them with spaces.'''
+        '''
+        Send commands directly! If there is multiple args it will join them with spaces.
+        Returns a concurrent.futures.Future that resolves to the robot's reply (asyncio.wrap_future makes it awaitable).
+        '''
         #assert(self.isOpen)
         cmdstring = ' '.join([str(a) for a in args])+';'
-        self.ctrl_sock.sendall(cmdstring.encode('utf8'))
+        fut = Future()
+        with self.send_lock: #replies are matched to commands in the order they went out
+            self.pending.append((cmdstring,fut))
+            try: self.ctrl_sock.sendall(cmdstring.encode('utf8'))
+            except Exception as e:
+                self.pending.pop()
+                raise e
+        if self.recorder is not None: self.recorder.command(cmdstring)
         #print(f'Sent: {cmdstring}')
+        return fut
+
+    def command(self,*args):
+        '''Like send, but the Future raises CommandError unless the robot replies ok.'''
+        fut = Future()
+        def check(reply):
+            if reply.exception() is not None: fut.set_exception(reply.exception())
+            elif reply.result() == 'ok': fut.set_result('ok')
+            else: fut.set_exception(CommandError(f"{' '.join(str(a) for a in args)}: {reply.result()}"))
+        self.send(*args).add_done_callback(check)
+        return fut
+
+    def wait(self,fut,timeout):
+        '''
+        Block until the command behind fut is acknowledged. Returns the reply.
+        If no reply comes within timeout (+ACK_TIMEOUT) it gives up with a warning, the action has most likely finished anyway.
+        '''
+        try: return fut.result(timeout+ACK_TIMEOUT)
+        except FutureTimeout:
+            print(f'No acknowledgement after {timeout+ACK_TIMEOUT:.1f}s, carrying on')
+            return None
+
+    def latest_pose(self):
+        '''Newest pushed pose (t, x, y, pitch, roll, yaw), see PoseHistory. Never blocks.'''
+        return self.poses.latest_pose()
+
+    def pose_at(self,t):
+        '''Pose interpolated to time t (eg. a frame's timestamp), see PoseHistory. Never blocks.'''
+        return self.poses.pose_at(t)
+
+    @property
+    def pos(self):
+        '''[x, y, yaw] of the newest push.'''
+        pose = self.latest_pose()
+        if pose is None: return [0,0,0]
+        return [pose[PoseHistory.X],pose[PoseHistory.Y],pose[PoseHistory.YAW]]
+
+    @property
+    def frame(self):
+        '''Newest video frame (no copy, None until the stream starts).'''
+        return self.frames.latest()[2]
+
+    @property
+    def dropped_frames(self): return self.frames.dropped
+
+    def wait_frame(self,after_seq=-1,timeout=None,copy=True):
+        '''
+        Block until a frame newer than after_seq arrives. Returns (seq, timestamp, frame), frame is None on timeout or if the robot closed.
+        - after_seq (int, default: -1): sequence number of the last frame seen
+        - timeout (number, default: None): seconds to wait
+        - copy (bool, default: True): return a private copy that is safe to keep
+        '''
+        return self.frames.wait(after_seq,timeout,copy)
+
+    def stream_stats(self):
+        '''Video decode counters, times in milliseconds per published frame.'''
+        n = max(1,self.decoded)
+        return {'grabbed':self.grabbed,'decoded':self.decoded,'skipped':self.skipped,'dropped':self.frames.dropped,
+            'decode_ms':self.decode_time/n*1000.0,'latency_ms':self.latency/n*1000.0}
+
+    def __open_stream(self):
+        '''Opens the video stream, retrying until stream_timeout. Returns the VideoCapture or None.'''
+        url = f'tcp://@{self.ip}:{VIDEO_PORT}'
+        params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC,int(self.stream_timeout*1000)] if hasattr(cv2,'CAP_PROP_OPEN_TIMEOUT_MSEC') else []
+        deadline = time()+self.stream_timeout
+        while self.isOpen:
+            stream = cv2.VideoCapture(url,cv2.CAP_FFMPEG,params) if params else cv2.VideoCapture(url)
+            if stream.isOpened(): return stream
+            stream.release()
+            if time() > deadline: break
+            sleep(0.1)
+        return None
 
     def __recvvideo(self):
         self.send('stream on')
         sleep(1)
         self.send('camera exposure small') #i saw this in their example code
-        self.stream = cv2.VideoCapture(f'tcp://@{self.ip}:{VIDEO_PORT}')
-        while not self.stream.isOpened(): sleep(0)
+        self.stream = self.__open_stream()
+        if self.stream is None:
+            print(f'Could not open the video stream within {self.stream_timeout}s')
+            self.frames.close()
+            return
         #self.stream.set(cv2.CAP_PROP_FRAME_WIDTH,1920)
         #self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT,1080)
-        while self.stream.isOpened() and self.isOpen: 
-            _, self.frame = self.stream.read()
-            self.hasNewFrame = True
+        period = 1.0/self.max_fps if self.max_fps else 0.0
+        due = 0.0 #when the next frame should be published
+        interval = 0.0 #running average of the time between frames
+        last = None
+        full = None #scratch frame when resizing, so retrieve doesn't allocate
+        while self.stream.isOpened() and self.isOpen:
+            if not self.stream.grab(): continue #grab demuxes & decodes, retrieve does the colour conversion & copy out
+            now = time()
+            self.grabbed += 1
+            if last is not None: interval += ((now-last)-interval)*0.1
+            last = now
+            if now < due-interval/2: #half a frame early counts as on time, otherwise jitter halves the rate
+                self.skipped += 1
+                continue
+            due = max(due+period,now)
+            slot = self.frames.write_slot()
+            if self.frame_size is None:
+                ok,frame = self.stream.retrieve(slot)
+            else:
+                ok,full = self.stream.retrieve(full)
+                frame = cv2.resize(full,self.frame_size,dst=slot if slot is not None and slot.shape[1::-1] == tuple(self.frame_size) else None,interpolation=cv2.INTER_AREA) if ok else None
+            if not ok: continue
+            self.decode_time += time()-now
+            self.frames.publish(frame,now)
+            if self.recorder is not None: self.recorder.frame(frame,now,self.frames.seq)
+            self.decoded += 1
+            self.latency += time()-now
+        self.frames.close()
         print("Video thread stopped!")
 
     def __recvmsg(self):
+        '''
+        Matches replies to pending commands in order. Replies end with ; but the robot also sends them without one,
+        so a partial reply is kept until either the ; arrives or nothing more comes for REPLY_IDLE.
+        '''
+        buf = ''
         while self.isOpen:
-            raw = self.ctrl_sock.recv(1024)
-            #print(f'Received: {raw.decode("utf-8")}')
+            try:
+                ready,_,_ = select.select([self.ctrl_sock],[],[],REPLY_IDLE if buf.strip() else 0.5)
+                raw = self.ctrl_sock.recv(1024) if ready else None
+            except (OSError,ValueError): break #ValueError once the socket is closed
+            if raw is None:
+                if not buf.strip(): continue
+                replies,buf = [buf],'' #went quiet after an unterminated reply, it is complete
+            elif not raw: break
+            else:
+                #print(f'Received: {raw.decode("utf-8")}')
+                *replies,buf = (buf+raw.decode('utf-8')).split(';')
+            for reply in replies:
+                if not reply.strip(): continue
+                with self.send_lock:
+                    if not self.pending: continue #reply to something not sent through send
+                    _,fut = self.pending.popleft()
+                if self.recorder is not None: self.recorder.reply(reply.strip())
+                fut.set_result(reply.strip())
+        self.__fail_pending(ConnectionError('control connection closed'))
         print("Feedback thread stopped!")
 
+    def __fail_pending(self,e):
+        with self.send_lock:
+            pending,self.pending = self.pending,deque()
+        for _,fut in pending:
+            if not fut.done(): fut.set_exception(e)
+
     def __recvpush(self):
-        self.send('chassis push position on pfreq 5 attitude on afreq 5') #receive data 5Hz
+        self.send('chassis push position on pfreq',self.push_freq,'attitude on afreq',self.push_freq)
+        x = y = pitch = roll = yaw = 0.0 #position and attitude can come in separate messages
         while self.isOpen:
-            raw = self.ctrl_sock.recv(1024)
-            data = raw.decode('utf-8').split(' ')
-            if data[:3] == ['chassis','push','position']:
-                self.pos[0],self.pos[1] = float(data[3]),float(data[4])
-            elif data[:3] == ['chassis','push','attitude']:
-                self.pos[2] = float(data[5])
+            try: raw,_ = self.push_sock.recvfrom(1024)
+            except socket.timeout: continue
+            except OSError: break
+            data = parse_push(raw.decode('utf-8'))
+            if len(data.get('position',[])) >= 2: x,y = data['position'][:2]
+            if len(data.get('attitude',[])) >= 3: pitch,roll,yaw = data['attitude'][:3]
+            if 'position' in data or 'attitude' in data:
+                t = time()
+                self.poses.append(t,x,y,pitch,roll,yaw)
+                if self.recorder is not None: self.recorder.pose(t,x,y,pitch,roll,yaw)
         print("Push thread stopped!")
 
 
@@ -134,53 +435,64 @@ class Robot:
         Move robot in metres relative to current position (will move diagonally). Speed limit of 0.3m/s.
         - x (number, default: 0.0): distance in x axis to move in metres
         - y (number, default: 0.0): distance in y axis to move in metres
-        - wait (bool, default: True): whether to wait for action to complete
+        - wait (bool, default: True): whether to wait for the robot to acknowledge completion
+        Returns a Future for the acknowledgement.
         '''
-        self.send('chassis','move','x',x,'y',y,'z',0.0,'vxy',min(speed,SPD_LIMIT))
-        if wait: sleep(calculate_move_time(x,y,speed)+buffer)
+        fut = self.command('chassis','move','x',x,'y',y,'z',0.0,'vxy',min(speed,SPD_LIMIT))
+        if wait: self.wait(fut,calculate_move_time(x,y,speed)+buffer)
+        return fut
 
     def speed(self,x=.0,y=.0,z=.0):
         '''
         Move robot at speed (% of 0.3m/s) (will move diagonally). Speed limit of 0.3m/s.
         - x (number, default: 0.0): between -100 to 100
         - y (number, default: 0.0): between -100 to 100
+        - z (number, default: 0.0): between -100 to 100 (% of 10deg/s)
+        Returns a Future for the acknowledgement.
         '''
-        self.send('chassis','speed','x',min(100.0,max(x,-100.0))/100.0*SPD_LIMIT,'y',min(100.0,max(y,-100.0))/100.0*SPD_LIMIT,'z',min(100.0,max(z,-100.0))/100.0*TURN_LIMIT) #doesnt account for diagonals properly
-    def brake(self): self.move(buffer=0.0)
+        return self.send('chassis','speed','x',min(100.0,max(x,-100.0))/100.0*SPD_LIMIT,'y',min(100.0,max(y,-100.0))/100.0*SPD_LIMIT,'z',min(100.0,max(z,-100.0))/100.0*TURN_LIMIT) #doesnt account for diagonals properly
+    def brake(self,wait=True): return self.move(wait=wait,buffer=0.0)
 
     def turn(self,ang,wait=True,buffer=BUFFER_TIME,speed=TURN_LIMIT):
         '''
         Rotate robot in degrees relative to current rotation. Speed limit of 10deg/s.
         - ang (number): angle to turn in degrees
-        - wait (bool, default: True): whether to wait for action to complete
+        - wait (bool, default: True): whether to wait for the robot to acknowledge completion
+        Returns a Future for the acknowledgement.
         '''
-        self.send('chassis','move','z',ang,'vz',min(speed,TURN_LIMIT))
-        if wait: sleep(calculate_turn_time(ang,speed)+buffer)
+        fut = self.command('chassis','move','z',ang,'vz',min(speed,TURN_LIMIT))
+        if wait: self.wait(fut,calculate_turn_time(ang,speed)+buffer)
+        return fut
 
-    def reset_origin(self):
-        self.send('robotic_arm','move','x',-100,'y',-300)
-        sleep(3)
+    def reset_origin(self,wait=True):
+        fut = self.command('robotic_arm','move','x',-100,'y',-300)
+        if wait: self.wait(fut,3)
         #transformation layer not necessary if arm motion is relative to this lowest position!
+        return fut
 
-    def cam_doll(self):
+    def cam_doll(self,wait=True):
         '''Move arm to position where camera is facing forwards'''
-        self.send('robotic_arm','move','x',100,'y',40) #in cm
+        fut = self.command('robotic_arm','move','x',100,'y',40) #in cm
         #10,20
-        sleep(1)
+        if wait: self.wait(fut,1)
+        return fut
         #raise NotImplementedError
 
-    def cam_ground(self):
+    def cam_ground(self,wait=True):
         '''TODO: Move arm to position where camera is facing ground'''
-        self.send('robotic_arm','move','x',210,'y',64) #in cm
-        self.open_claw()
-        sleep(1)
+        fut = self.command('robotic_arm','move','x',210,'y',64) #in cm
+        claw = self.open_claw()
+        if wait:
+            self.wait(fut,1)
+            self.wait(claw,1)
+        return fut
         #raise NotImplementedError
 
     def open_claw(self):
-        self.send('robotic_gripper open 4')
+        return self.command('robotic_gripper open 4')
 
     def close_claw(self):
-        self.send('robotic_gripper close 2')
+        return self.command('robotic_gripper close 2')
 
     def light_red(self):
         print("Blink Red!")
@@ -212,17 +524,131 @@ class PID():
         self.ep = e
         return v
 
+class ControlLoop:
+    '''
+    Runs a PID at a fixed rate on its own thread & drives the chassis with chassis speed commands.
+    measure() hands it measurements from any thread, each tick uses the newest one, extrapolated by its age at the rate it was last changing.
+    A measurement can be older than the detector's latency when it arrives & is still used, only its extrapolation is capped at max_age.
+    Speed commands are coalesced: a setpoint only goes out if it changed by more than deadband, and at most max_cmd_rate times a second.
+    The robot is stopped (sent once, like any other setpoint) after lost(), or when no measurement has arrived for max_age.
+    - robot (Robot): robot to drive
+    - pid (PID): controller, updated once per tick
+    - to_speed (callable): to_speed(pid output) -> (x, y, z) in % as Robot.speed takes them
+    - rate (number, default: 20): ticks per second
+    - max_age (number, default: 2.0): seconds without a new measurement before stopping, longer than a detection takes
+    - deadband (number, default: 1.0): % a setpoint has to change by before it is resent
+    - max_cmd_rate (number, default: 10): most speed commands per second, stopping is never held back
+    '''
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def __init__(self,robot,pid,to_speed,rate=20,max_age=2.0,deadband=1.0,max_cmd_rate=10):
+        self.robot = robot
+        self.pid = pid
+        self.to_speed = to_speed
+        self.period = 1.0/rate
+        self.max_age = max_age
+        self.deadband = deadband
+        self.min_cmd_gap = 1.0/max_cmd_rate
+        self.lock = Lock()
+        self.meas = None #(stamp, value) newest measurement
+        self.received = 0.0 #when it arrived, stamp is when it was captured
+        self.prev_meas = None #the one before it, for the extrapolation
+        self.output = None #newest PID output, None while stopped
+        self.sent = None #(x, y, z) last setpoint sent
+        self.sent_at = 0.0
+        self.stopped = Event()
+        self.thread = Thread(target=self.__run,daemon=True)
+        self.ticks = 0
+        self.overruns = 0 #ticks that started a whole period late
+        self.commands = 0 #speed commands sent
+        self.coalesced = 0 #ticks whose setpoint didn't need sending
+        self.jitter = deque(maxlen=JITTER_SLOTS) #seconds each tick started after it was due
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stops the loop & the robot.'''
+        self.stopped.set()
+        self.thread.join()
+        self.robot.speed()
+        self.sent = (0.0,0.0,0.0)
+
+    def measure(self,value,stamp=None):
+        '''
+        New measurement for the PID.
+        - stamp (number, default: None): time.time() the measurement is from (eg. the frame's timestamp), None is now
+        '''
+        now = time()
+        with self.lock:
+            self.prev_meas,self.meas = self.meas,(now if stamp is None else stamp,value)
+            self.received = now
+
+    def lost(self):
+        '''The measured thing is gone, stop at the next tick instead of waiting for max_age.'''
+        with self.lock: self.prev_meas,self.meas = None,None
+
+    def estimate(self,now):
+        '''Newest measurement extrapolated to now, None after lost() or if none arrived in the last max_age.'''
+        with self.lock: meas,prev,received = self.meas,self.prev_meas,self.received
+        if meas is None or now-received > self.max_age: return None
+        t,value = meas
+        if prev is not None and t > prev[0]: value += (value-prev[1])/(t-prev[0])*min(now-t,self.max_age) #not further than it can be trusted
+        return value
+
+    def __send(self,setpoint,now):
+        if self.sent is not None and max(abs(a-b) for a,b in zip(setpoint,self.sent)) <= self.deadband:
+            self.coalesced += 1
+            return
+        stopping = not any(setpoint)
+        if not stopping and now-self.sent_at < self.min_cmd_gap: #held back, goes out on a later tick if still different
+            self.coalesced += 1
+            return
+        self.robot.speed(*setpoint)
+        self.sent,self.sent_at = setpoint,now
+        self.commands += 1
+
+    def __run(self):
+        due = prev = time()
+        while not self.stopped.wait(max(0.0,due-time())):
+            now = time()
+            self.jitter.append(now-due)
+            self.ticks += 1
+            if now-due > self.period: #fell a whole tick behind, skip the missed ones instead of bursting
+                self.overruns += 1
+                due = now
+            due += self.period
+
+            value = self.estimate(now)
+            if value is None:
+                self.output = None
+                self.__send((0.0,0.0,0.0),now)
+            else:
+                self.output = self.pid.update(value,now-prev)
+                self.__send(tuple(float(v) for v in self.to_speed(self.output)),now)
+            prev = now
+
+    def stats(self):
+        '''Tick & command counts with the tick start jitter in milliseconds.'''
+        jitter = np.array(self.jitter)*1000.0
+        return {'ticks':self.ticks,'overruns':self.overruns,'commands':self.commands,'coalesced':self.coalesced,
+            'jitter_mean':float(jitter.mean()) if len(jitter) else 0.0,
+            'jitter_p95':float(np.percentile(jitter,95)) if len(jitter) else 0.0,
+            'jitter_max':float(jitter.max()) if len(jitter) else 0.0}
+
 if __name__ == "__main__":
     #python -i robot.py
     with Robot('192.168.2.1') as robot:
         robot.reset_origin()
         robot.cam_doll()
         cv2.namedWindow('Livefeed', cv2.WINDOW_AUTOSIZE)
+        seq = -1
         while True:
-            if not robot.hasNewFrame: continue
-            robot.hasNewFrame = False
-            cur_im = robot.frame.copy()
+            seq,_,cur_im = robot.wait_frame(seq,timeout=1.0,copy=False)
+            if cur_im is None: continue
             cv2.imshow('Livefeed',cur_im)
             cv2.waitKey(1)
             if cv2.getWindowProperty('Livefeed',cv2.WND_PROP_VISIBLE) < 1: break
-    cv2.destroyAllWindows()
\ No newline at end of file
+    cv2.destroyAllWindows()
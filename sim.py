@@ -0,0 +1,233 @@
+'''
+Local stand-in for the RoboMaster EP's text SDK, so robot.py can be run & timed without the robot.
+Serves the control (CTRL_PORT), push (PUSH_PORT), video (VIDEO_PORT) and IP broadcast (IP_PORT) ports.
+- Commands are answered with ok after a delay similar to the real robot (chassis moves take as long as the motion would)
+- Video is H.264 from a recorded file, an image or an image glob, re-encoded by ffmpeg at a fixed fps
+- Chassis position/attitude pushes follow the motion commands it received
+
+python sim.py --video unnamed.png --fps 30
+Then Robot() (which looks for the broadcast) or Robot('127.0.0.1') connects to it.
+For scripts with a hardcoded IP, add it to loopback first (eg. sudo ip addr add 192.168.2.1/32 dev lo) and use --host 192.168.2.1.
+'''
+import argparse
+import math
+import shutil
+import socket
+import subprocess
+from threading import Thread, Event, Lock
+from time import sleep, time
+from robot import VIDEO_PORT, CTRL_PORT, PUSH_PORT, IP_PORT, PUSH_FREQS
+
+CMD_DELAYS = { #seconds before the ok, by command prefix (longest prefix wins)
+    'command': 0.01,
+    'robotic_arm move': 1.0,
+    'robotic_gripper': 0.5,
+    'stream on': 0.2,
+    'led': 0.01,
+}
+DEFAULT_DELAY = 0.01
+PHYSICS_HZ = 100
+
+class Simulator:
+    '''
+    Simulated robot. start() serves all ports from background threads, stop() shuts them down.
+    - host (string, default: '127.0.0.1'): address to serve on (and that the broadcast will come from)
+    - video (string, default: 'unnamed.png'): video file, image, or image glob (eg. 'frames/*.png') to stream
+    - fps (number, default: 30): video frame rate
+    - size (tuple, default: (1280,720)): video resolution, the robot streams 720p
+    - delays (dict, default: CMD_DELAYS): per-command reply delays
+    '''
+    def __init__(self,host='127.0.0.1',video='unnamed.png',fps=30,size=(1280,720),delays=CMD_DELAYS):
+        self.host = host
+        self.video = video
+        self.fps = fps
+        self.size = size
+        self.delays = delays
+
+        self.stopped = Event()
+        self.lock = Lock()
+        self.pose = [0.0,0.0,0.0] #x, y in metres, yaw in degrees (+ is clockwise)
+        self.vel = [0.0,0.0,0.0] #vx, vy in m/s, wz in deg/s, in the robot's frame
+        self.push_freq = 0 #Hz, 0 is off
+        self.client_ip = None
+        self.commands = [] #(time, command) received, for tests & benchmarks
+        self.threads = []
+        self.socks = []
+
+    def __enter__(self): return self.start()
+    def __exit__(self,exc_type,exc_val,exc_tb): self.stop()
+
+    def start(self):
+        for target in (self.__broadcast,self.__physics,self.__push,self.__serve_ctrl,self.__serve_video):
+            t = Thread(target=target,daemon=True)
+            t.start()
+            self.threads.append(t)
+        print(f'Simulator serving on {self.host}')
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for s in self.socks:
+            try: s.close()
+            except OSError: pass
+        for t in self.threads: t.join(timeout=2)
+
+    def __listen(self,port):
+        s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        s.bind((self.host,port))
+        s.listen(1)
+        s.settimeout(0.5)
+        self.socks.append(s)
+        return s
+
+    def __accept(self,server):
+        '''Next client or None once stopped.'''
+        while not self.stopped.is_set():
+            try: return server.accept()
+            except socket.timeout: continue
+            except OSError: break
+        return None
+
+    #########
+    # PORTS #
+    #########
+
+    def __broadcast(self):
+        with socket.socket(socket.AF_INET,socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET,socket.SO_BROADCAST,1)
+            s.bind((self.host,0)) #so the receiver sees our host as the robot's address
+            dest = self.host if self.host.startswith('127.') else '<broadcast>'
+            while not self.stopped.wait(1.0):
+                try: s.sendto(f'robot ip {self.host}'.encode('utf8'),(dest,IP_PORT))
+                except OSError: pass
+
+    def __serve_ctrl(self):
+        server = self.__listen(CTRL_PORT)
+        while True:
+            client = self.__accept(server)
+            if client is None: break
+            conn,addr = client
+            self.client_ip = addr[0]
+            with conn: self.__handle_ctrl(conn)
+            with self.lock: self.vel,self.push_freq = [0.0,0.0,0.0],0
+
+    def __handle_ctrl(self,conn):
+        '''Commands are processed & answered one at a time in order, like the robot does.'''
+        conn.settimeout(0.5)
+        buf = ''
+        while not self.stopped.is_set():
+            try: raw = conn.recv(1024)
+            except socket.timeout: continue
+            except OSError: return
+            if not raw: return
+            *cmds,buf = (buf+raw.decode('utf-8')).split(';')
+            for cmd in cmds:
+                cmd = ' '.join(cmd.split())
+                if not cmd: continue
+                self.commands.append((time(),cmd))
+                reply = self.execute(cmd)
+                try: conn.sendall(f'{reply};'.encode('utf8'))
+                except OSError: return
+                if cmd == 'quit': return
+
+    def __push(self):
+        with socket.socket(socket.AF_INET,socket.SOCK_DGRAM) as s:
+            while not self.stopped.is_set():
+                with self.lock: freq,(x,y,yaw) = self.push_freq,self.pose
+                if freq == 0 or self.client_ip is None:
+                    sleep(0.1)
+                    continue
+                msg = f'chassis push position {x:.3f} {y:.3f} ;attitude 0.000 0.000 {yaw:.3f} ;'
+                try: s.sendto(msg.encode('utf8'),(self.client_ip,PUSH_PORT))
+                except OSError: pass
+                sleep(1.0/freq)
+
+    def video_cmd(self):
+        '''ffmpeg command that writes the H.264 elementary stream to stdout in real time.'''
+        if shutil.which('ffmpeg') is None: raise RuntimeError('ffmpeg is needed to stream video')
+        w,h = self.size
+        if any(c in self.video for c in '*?['): src = ['-pattern_type','glob','-framerate',str(self.fps),'-i',self.video]
+        elif self.video.lower().endswith(('.png','.jpg','.jpeg','.bmp')): src = ['-loop','1','-framerate',str(self.fps),'-i',self.video]
+        else: src = ['-stream_loop','-1','-i',self.video]
+        return (['ffmpeg','-loglevel','error','-re']+src+
+            ['-vf',f'fps={self.fps},scale={w}:{h}','-an','-c:v','libx264','-preset','ultrafast','-tune','zerolatency',
+             '-pix_fmt','yuv420p','-g',str(int(self.fps)),'-f','h264','-'])
+
+    def __serve_video(self):
+        if shutil.which('ffmpeg') is None:
+            print('ffmpeg not found, simulating without video')
+            return
+        server = self.__listen(VIDEO_PORT)
+        while True:
+            client = self.__accept(server)
+            if client is None: break
+            conn,_ = client
+            proc = subprocess.Popen(self.video_cmd(),stdout=subprocess.PIPE)
+            try:
+                with conn:
+                    while not self.stopped.is_set():
+                        chunk = proc.stdout.read1(65536)
+                        if not chunk: break
+                        conn.sendall(chunk)
+            except OSError: pass #client went away
+            finally:
+                proc.kill()
+                proc.wait()
+
+    #############
+    # BEHAVIOUR #
+    #############
+
+    def __physics(self):
+        dt = 1.0/PHYSICS_HZ
+        while not self.stopped.wait(dt):
+            with self.lock:
+                vx,vy,wz = self.vel
+                x,y,yaw = self.pose
+                a = math.radians(yaw)
+                self.pose = [x+(vx*math.cos(a)-vy*math.sin(a))*dt,y+(vx*math.sin(a)+vy*math.cos(a))*dt,(yaw+wz*dt+180.0)%360.0-180.0]
+
+    def delay(self,cmd):
+        keys = [k for k in self.delays if cmd.startswith(k)]
+        return self.delays[max(keys,key=len)] if keys else DEFAULT_DELAY
+
+    def execute(self,cmd):
+        '''Carries out one command (blocking for as long as the robot would) & returns the reply.'''
+        words = cmd.split()
+        args = dict(zip(words[2::2],words[3::2]))
+        try:
+            if words[:2] == ['chassis','move']:
+                x,y,z = float(args.get('x',0)),float(args.get('y',0)),float(args.get('z',0))
+                vxy,vz = float(args.get('vxy',0.5)),float(args.get('vz',30))
+                duration = max(math.hypot(x,y)/vxy if vxy else 0.0,abs(z)/vz if vz else 0.0)
+                if duration > 0:
+                    with self.lock: self.vel = [x/duration,y/duration,z/duration]
+                    self.stopped.wait(duration)
+                with self.lock: self.vel = [0.0,0.0,0.0]
+                return 'ok'
+            if words[:2] == ['chassis','speed']:
+                with self.lock: self.vel = [float(args.get('x',0)),float(args.get('y',0)),float(args.get('z',0))]
+                return 'ok'
+            if words[:2] == ['chassis','push']:
+                freq = int(float(args.get('pfreq',args.get('afreq',5))))
+                if freq not in PUSH_FREQS: return 'error'
+                with self.lock: self.push_freq = 0 if 'off' in words else freq
+                return 'ok'
+            if cmd == 'chassis position ?':
+                with self.lock: return '{:.3f} {:.3f} {:.3f}'.format(*self.pose)
+        except ValueError:
+            return 'error'
+        self.stopped.wait(self.delay(cmd))
+        return 'ok'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--video',default='unnamed.png',help='video file, image or image glob')
+    parser.add_argument('--fps',type=float,default=30)
+    args = parser.parse_args()
+    with Simulator(args.host,args.video,args.fps) as sim:
+        try:
+            while True: sleep(1)
+        except KeyboardInterrupt: pass
@@ -0,0 +1,148 @@
+'''
+Offline threshold sweeps for task_tune. Recorded frames go through the models once with permissive thresholds & the raw (pre-NMS)
+detections are cached, then any grid of NMS/score thresholds & doll score coefficients is replayed on the cache across all cores,
+without the robot or the models.
+
+python task_tune.py --build-cache 'scans/doll1/*.png=tops,skirts' 'scans/doll2.mp4=trousers' --cache tune_cache.npz
+python task_tune.py --sweep --cache tune_cache.npz --human-score 0.9 0.95 --clothes-nms 0.2 0.3 --penalty 0.3 0.5 --sureness 0.4 0.5
+
+Each scan is a recorded session (recorder.py), a glob of images or a video of one doll, = the clothes it wears.
+A scan should match when it wears all the wanted clothing.
+The clothes model sees the crop of the most confident person box, which is the same for every human NMS threshold & any score
+threshold it passes, so one clothes pass per frame covers the whole grid.
+'''
+import json
+import os
+from itertools import product
+from multiprocessing import Pool
+import numpy as np
+import torch
+from detectron2.layers import batched_nms
+from recorder import read_frames
+
+CACHE_NMS = 1.0 #IoU never exceeds 1, so nothing is suppressed
+CACHE_SCORE = 0.05 #lowest score threshold a sweep can replay
+CACHE_DETS = 1000 #detections kept per image before NMS, the live predictors keep 100 after it
+MAX_DETS = 100
+
+def parse_scan(s):
+    '''"GLOB=item,item" -> (GLOB, [items])'''
+    pattern,_,worn = s.rpartition('=')
+    return pattern,[w for w in worn.split(',') if w]
+
+def build_cache(scans,path,margin=0.1,min_area=0,max_area=100000):
+    '''
+    Runs every frame of scans through both models once & saves the raw detections to path (npz).
+    - scans (list): (pattern, [clothes worn]) per scan
+    - margin, min_area, max_area: as check_doll uses them, they decide the crop so can't be swept
+    '''
+    from models import get_human_model, get_clothes_model, locate_person, crop_bbox, get_metadata
+    human_model = get_human_model(nms_thres=CACHE_NMS,score_thres=CACHE_SCORE,max_dets=CACHE_DETS)
+    clothes_model = get_clothes_model(nms_thres=CACHE_NMS,score_thres=CACHE_SCORE,max_dets=CACHE_DETS)
+    frame_scan,crop_boxes = [],[]
+    human,clothes = {'boxes':[],'scores':[],'classes':[],'counts':[]},{'boxes':[],'scores':[],'classes':[],'counts':[]}
+    def add(store,instances):
+        store['boxes'].append(instances.pred_boxes.tensor.numpy())
+        store['scores'].append(instances.scores.numpy())
+        store['classes'].append(instances.pred_classes.numpy().astype(np.int16))
+        store['counts'].append(len(instances))
+    empty = {'boxes':np.zeros((0,4),np.float32),'scores':np.zeros(0,np.float32),'classes':np.zeros(0,np.int16)}
+    for scan,(pattern,_) in enumerate(scans):
+        n = 0
+        for im in read_frames(pattern):
+            outputs = human_model(im)
+            add(human,outputs['instances'].to('cpu'))
+            box,_,_ = locate_person(outputs,min_area,max_area)
+            if box is None:
+                crop_boxes.append([np.nan]*4)
+                for k,v in empty.items(): clothes[k].append(v)
+                clothes['counts'].append(0)
+            else:
+                crop,_ = crop_bbox(im,box,b=margin)
+                crop_boxes.append(box)
+                add(clothes,clothes_model(crop)['instances'].to('cpu'))
+            frame_scan.append(scan)
+            n += 1
+        print(f'{pattern}: {n} frames')
+    np.savez_compressed(path,frame_scan=np.array(frame_scan,np.int32),crop_boxes=np.array(crop_boxes,np.float32),
+        **{f'human_{k}':np.concatenate(v) for k,v in human.items() if k != 'counts'},human_counts=np.array(human['counts'],np.int32),
+        **{f'clothes_{k}':np.concatenate(v) for k,v in clothes.items() if k != 'counts'},clothes_counts=np.array(clothes['counts'],np.int32),
+        meta=json.dumps({'classes':get_metadata().thing_classes,'scans':scans,'margin':margin,'min_area':min_area,'max_area':max_area}))
+    print(f'{len(frame_scan)} frames cached to {path}')
+
+class DetectionCache:
+    '''Raw detections of a build_cache file, per frame.'''
+    def __init__(self,path):
+        data = np.load(path)
+        self.meta = json.loads(str(data['meta']))
+        self.frame_scan = data['frame_scan']
+        self.human = self.__split(data,'human')
+        self.clothes = self.__split(data,'clothes')
+
+    @staticmethod
+    def __split(data,name):
+        '''[(boxes, scores, classes)] per frame.'''
+        ends = np.cumsum(data[f'{name}_counts'])[:-1]
+        return list(zip(*(np.split(data[f'{name}_{k}'],ends) for k in ('boxes','scores','classes'))))
+
+def replay_nms(boxes,scores,classes,nms_thres,score_thres,max_dets=MAX_DETS):
+    '''Indices a predictor with these thresholds would have kept, best first (score filter, per class NMS, top max_dets).'''
+    idx = np.nonzero(scores > score_thres)[0]
+    if len(idx) == 0: return idx
+    keep = batched_nms(torch.from_numpy(boxes[idx]),torch.from_numpy(scores[idx]),torch.from_numpy(classes[idx].astype(np.int64)),nms_thres)
+    return idx[keep[:max_dets].numpy()]
+
+_cache = None
+def _init_worker(path):
+    global _cache
+    torch.set_num_threads(1) #one core per worker
+    _cache = DetectionCache(path)
+
+def _replay(task):
+    '''Scores every coefficient combination for one (human nms, human score, clothes nms, clothes score).'''
+    (hn,hs,cn,cs),coeffs,wanted,snaps = task
+    meta = _cache.meta
+    classes = meta['classes']
+    frames_with_person = 0
+    valid = [[] for _ in meta['scans']] #per scan, class score sums of the frames check_doll would use
+    for scan,(hb,hsc,hc),(cb,csc,cc) in zip(_cache.frame_scan,_cache.human,_cache.clothes):
+        keep = replay_nms(hb,hsc,hc,hn,hs)
+        areas = (hb[keep,2]-hb[keep,0])*(hb[keep,3]-hb[keep,1])
+        if not ((areas > meta['min_area'])&(areas < meta['max_area'])).any(): continue
+        frames_with_person += 1
+        keep = replay_nms(cb,csc,cc,cn,cs)
+        if len(keep) == 0: continue
+        valid[scan].append(np.bincount(cc[keep],weights=csc[keep],minlength=len(classes)))
+    wanted_mask = np.array([c in wanted for c in classes])
+    truths = [set(wanted) <= set(worn) for _,worn in meta['scans']]
+    rows = []
+    for penalty,sureness in coeffs:
+        weights = np.where(wanted_mask,1.0,-penalty)
+        correct = trials = undecided = 0
+        for truth,scores in zip(truths,valid):
+            scores = np.array(scores).reshape(-1,len(classes))
+            if len(scores) < snaps: #check_doll would still be waiting for snaps
+                undecided += 1
+                continue
+            for chunk in np.split(scores[:len(scores)//snaps*snaps],len(scores)//snaps): #one trial per snaps frames
+                decision = float((chunk@weights).mean()) > len(wanted)*sureness
+                correct += decision == truth
+                trials += 1
+        rows.append({'human_nms':hn,'human_score':hs,'clothes_nms':cn,'clothes_score':cs,'penalty':penalty,'sureness':sureness,
+            'accuracy':correct/trials if trials else 0.0,'trials':trials,'undecided_scans':undecided,
+            'person_rate':frames_with_person/max(1,len(_cache.frame_scan)),'snap_rate':sum(map(len,valid))/max(1,len(_cache.frame_scan))})
+    return rows
+
+def sweep(path,wanted,human_nms,human_score,clothes_nms,clothes_score,penalty,sureness,snaps=5,workers=None):
+    '''
+    Replays every combination of the threshold & coefficient lists on the cache at path. Returns one dict per combination, best first.
+    Thresholds are split across worker processes, the coefficients are cheap & replayed inside each.
+    - wanted (list): clothes the scans are checked for
+    - snaps (int, default: 5): frames per check_doll decision, each scan gives one trial per snaps usable frames
+    '''
+    if min(human_score+clothes_score) < CACHE_SCORE: raise ValueError(f'score thresholds below {CACHE_SCORE} are not in the cache')
+    coeffs = list(product(penalty,sureness))
+    tasks = [(t,coeffs,wanted,snaps) for t in product(human_nms,human_score,clothes_nms,clothes_score)]
+    with Pool(workers or os.cpu_count(),initializer=_init_worker,initargs=(path,)) as pool:
+        rows = [r for rs in pool.imap_unordered(_replay,tasks) for r in rs]
+    return sorted(rows,key=lambda r:(-r['accuracy'],-r['snap_rate']))
@@ -1,35 +1,69 @@
-import cv2
-from models import get_human_model, get_clothes_model, get_most_confident, visualize, crop_bbox, id_to_label, metadata
-from robot import Robot,PID
+import argparse
+import numpy as np
+from models import get_human_model, get_clothes_model, locate_person, get_metadata, DetectionPipeline, MotionGate
+from display import Display, draw_detections
+from tracker import DollTracker
+from evidence import EvidenceAggregator
+from model_server import ModelServer
+from recorder import Recorder
+from robot import Robot,PID,ControlLoop
 from extract_clothes import get_clothes_class
-import time
+from threading import Thread
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--headless',action='store_true',help='no windows or drawing, for competition runs')
+parser.add_argument('--redetect-every',type=int,default=10,help='frames between detections while tracking the doll in grab_doll, 1 detects every frame')
+parser.add_argument('--control-rate',type=float,default=20,help='Hz the PID & speed commands run at in grab_doll')
+parser.add_argument('--control-timeout',type=float,default=2.0,help='seconds grab_doll keeps driving on its last measurement, longer than one detection takes')
+parser.add_argument('--confidence',type=float,default=0.95,help='how sure check_doll must be to decide before it has all its snaps')
+parser.add_argument('--max-fps',type=float,default=None,help='frames per second the video thread publishes, the rest are skipped before colour conversion')
+parser.add_argument('--record',default=None,metavar='DIR',help='record frames, commands, poses & detections to this session directory, see recorder.py')
+parser.add_argument('--model-server',type=int,default=0,metavar='WORKERS',help='run the models in this many worker processes instead of in this one')
+args = parser.parse_args()
 
 #nms is threshold for IoU, score is threshold for confidence
-human_model = get_human_model(nms_thres=0.01,score_thres=0.9)
-clothes_model = get_clothes_model(nms_thres=0.3,score_thres=0.7)
+human_kwargs = dict(nms_thres=0.01,score_thres=0.9)
+clothes_kwargs = dict(nms_thres=0.3,score_thres=0.7)
+server = ModelServer(human_kwargs,clothes_kwargs,workers=args.model_server).start() if args.model_server else None #before any other thread starts
+display = Display(['Livefeed','Humanfeed','Clothesfeed'],headless=args.headless).start()
+recorder = Recorder(args.record,jpeg_quality=90).start() if args.record else None
+
+human_model = clothes_model = None
+def load_models():
+    '''Builds the predictors, run in the background while the robot connects.'''
+    global human_model,clothes_model
+    clothes_text.load() #the text classifier is needed first, as soon as the description is typed
+    if server is not None:
+        human_model,clothes_model = server.client('human'),server.client('clothes')
+        return
+    human_model = get_human_model(**human_kwargs,batch=True)
+    clothes_model = get_clothes_model(**clothes_kwargs,batch=True)
+
 clothes_text = get_clothes_class(".","./encoded_words.pkl")
 
-def find_doll(im,min_area=0,max_area=100000):
-    human_boxes = human_model(im)
-    best_box = get_most_confident(human_boxes,min_area,max_area) #returns only 1 box in Boxes
-    if len(best_box) == 0: return None,None,None
-    box_area = best_box.area().tolist()[0]
-    box_centre = best_box.get_centers().tolist()[0]
-    cv2.imshow('Humanfeed',visualize(im,human_boxes))
+human_gate = MotionGate() #reuse person boxes in check_doll while the scene is unchanged, the garment model always runs
+
+def show_doll(im,human_boxes,box_area,box_centre):
+    display.show_instances('Humanfeed',im,human_boxes,['person'])
     print(f'box area: {box_area}, box centre: {box_centre}')
-    return best_box.tensor.tolist()[0],box_area,box_centre
 
-cv2.namedWindow('Livefeed', cv2.WINDOW_AUTOSIZE)
-cv2.namedWindow('Humanfeed', cv2.WINDOW_AUTOSIZE)
-cv2.namedWindow('Clothesfeed', cv2.WINDOW_AUTOSIZE)
+def find_doll(im,min_area=0,max_area=100000):
+    human_boxes = human_model(im)
+    best_box,box_area,box_centre = locate_person(human_boxes,min_area,max_area) #only the most confident box
+    if best_box is None: return None,None,None
+    show_doll(im,human_boxes,box_area,box_centre)
+    return best_box,box_area,box_centre
 
 doll_pos = -1
-with Robot() as robot:
+loader = Thread(target=load_models,daemon=True)
+loader.start()
+with Robot(max_fps=args.max_fps,recorder=recorder) as robot:
     robot.reset_origin()
     robot.cam_doll()
 
     wanted_clothing = clothes_text.process_input(input("Enter description: "))
     print(wanted_clothing)
+    loader.join()
 
     '''Get to the centre of task 2 zone
     
@@ -40,49 +74,47 @@ with Robot() as robot:
     '''
     robot.move(x=0.8) #get off exit completely
     
-    def check_doll():
+    scan_log = [] #(position, frames used, decision) per check_doll, to see how much early stopping saves
+    def check_doll(position,min_fresh=0.3):
+        '''min_fresh is the fraction of snaps whose person box must come from fresh inference rather than the motion-gated cache'''
         move_zoom = 0.5#0.3 #move forward to get clearer view (can try setting to 0)
-        confirming_snaps = 10 #number of confirming pictures to take (the more the better)
+        confirming_snaps = 10 #most confirming pictures to take, clear cases stop earlier
         robot.move(x=move_zoom)
 
-        cat_scores = {k:0.0 for k in metadata.thing_classes}
-        doll_score = 0.0
-        snaps = 0 #number of pictures taken
-        while snaps < confirming_snaps:
-            if not robot.hasNewFrame: continue
-            robot.hasNewFrame = False
-            cur_im = robot.frame.copy()
-            cv2.imshow('Livefeed',cur_im)
-
-            cv2.waitKey(1)
-            if cv2.getWindowProperty('Livefeed',cv2.WND_PROP_VISIBLE) < 1: break
-
-            best_box,_,_ = find_doll(cur_im)
-            if best_box is None:
-                cv2.imshow('Humanfeed',cur_im)
-                continue
-
-            new_im,_ = crop_bbox(cur_im,best_box,b=0.05) #b is the extra margin
-            outputs = clothes_model(new_im)['instances'].to('cpu')
-            cv2.imshow('Clothesfeed',visualize(new_im,{'instances':outputs}))
-            if len(outputs) == 0: continue
-
-            classes = id_to_label(outputs.pred_classes.tolist())
-            scores = outputs.scores.tolist()
-            bboxes = outputs.pred_boxes.tensor.tolist()
-            for cat,score,bbox in zip(classes,scores,bboxes):
-                #TODO: use bbox to check if valid. aka everything about dresses is less than 0.8*area, tops are on top, skirts are below...
-                cat_scores[cat] += score
-            snaps += 1
+        class_names = get_metadata().thing_classes
+        #TODO: subtract only for clearly contradictory clothes item, in case request only trousers but the doll wears trousers + top?
+        weights = np.array([1.0 if cat in wanted_clothing else -0.3 for cat in class_names]) #-0.3 is arbitrary coefficient
+        evidence = EvidenceAggregator(weights,len(wanted_clothing)*0.4,confidence=args.confidence,max_frames=confirming_snaps) #0.4 is sureness per snap
+        source = lambda seq: robot.wait_frame(seq,timeout=0.5)
+        human_gate.reset_stats()
+        with DetectionPipeline(source,human_model,clothes_model,margin=0.05,after_seq=robot.frames.seq,batch_size=evidence.min_frames,
+                human_gate=human_gate,min_fresh=min_fresh) as pipeline: #b is the extra margin, small batches so it can stop early
+            while not evidence.done:
+                r = pipeline.get(timeout=1.0)
+                if r is None: continue
+                display.show('Livefeed',r.im)
+                if display.closed('Livefeed'): break
+
+                if r.box is None:
+                    display.show('Humanfeed',r.im)
+                    continue
+                show_doll(r.im,r.human_outputs,r.box_area,r.box_centre)
+
+                outputs = r.clothes_outputs['instances']
+                display.show_instances('Clothesfeed',r.crop,outputs,class_names)
+                if recorder is not None:
+                    recorder.detections(r.seq,'human',r.human_outputs,r.stamp)
+                    recorder.detections(r.seq,'clothes',outputs,r.stamp,offset=r.offset)
+                if len(outputs) == 0: continue
 
-        print(cat_scores)
-        for cat,score in cat_scores.items():
-            #TODO: subtract only for clearly contradictory clothes item, in case request only trousers but the doll wears trousers + top?
-            if cat in wanted_clothing: doll_score += score
-            else: doll_score -= 0.3*score #is arbitrary coefficient
+                #TODO: use bbox to check if valid. aka everything about dresses is less than 0.8*area, tops are on top, skirts are below...
+                evidence.update(r.clothes_scores,fresh=not r.clothes_cached) #a reused person box still gives new garment evidence
 
-        print(doll_score) #tbh should be returning this to rank... but if that was necessary, LED misdetect already happened.
-        isCorrect = doll_score > confirming_snaps*len(wanted_clothing)*0.4 #last one is sureness
+        print(f'person cache hits/misses: {human_gate.window_hits}/{human_gate.window_misses}')
+        print(dict(zip(class_names,evidence.class_means.tolist())))
+        isCorrect = evidence.result()
+        print(f'{position}: {"match" if isCorrect else "no match"} after {evidence.frames} snaps ({evidence.cached} cached skipped), mean score {evidence.mean:.2f}, P(match) {evidence.p_accept:.3f}')
+        scan_log.append((position,evidence.frames,isCorrect))
         if isCorrect: robot.light_green()
         else: robot.light_red()
 
@@ -92,48 +124,49 @@ with Robot() as robot:
     box_pid = PID(1280.0/2,0.2500,0.0,0.0)
     def grab_doll():
         robot.open_claw()
-        prev_time = time.time()
-        while True:
-            if not robot.hasNewFrame: continue
-            robot.hasNewFrame = False
-            cur_im = robot.frame.copy()
-            cv2.imshow('Livefeed',cur_im)
-
-            cv2.waitKey(1)
-            if cv2.getWindowProperty('Livefeed',cv2.WND_PROP_VISIBLE) < 1: break
-            
-            best_box,box_area,box_centre = find_doll(cur_im)
-            if best_box is None:
-                cv2.imshow('Humanfeed',cur_im)
-                robot.brake()
-                continue
-
-            cur_time = time.time()
-            val = box_pid.update(box_centre[0],cur_time-prev_time)
-            prev_time = cur_time
-
-            robot.speed(x=35,z=-val)
-            print(f'Bottom Edge: {best_box[3]}, PID Turn %{-val}')
-
-            if (box_area > 54000 and best_box[3] > 690): #for 720p #box_area > 64000 #abs(val) < 15 and #TODO: TUNE THIS
-                if -val > 5: robot.turn(8)
-                elif -val < -5: robot.turn(-8)
-                robot.move(x=0.3,speed=0.1)
-                break
+        tracker = DollTracker(find_doll,redetect_every=args.redetect_every) #detector only runs every few frames, optical flow in between
+        seq = -1
+        reached = False
+        with ControlLoop(robot,box_pid,lambda val: (35,0,-val),rate=args.control_rate,max_age=args.control_timeout) as control: #PID & speed commands at a fixed rate, this loop only measures
+            while True:
+                seq,stamp,cur_im = robot.wait_frame(seq,timeout=1.0)
+                if cur_im is None: continue
+                display.show('Livefeed',cur_im)
+                if display.closed('Livefeed'): break
+
+                best_box,box_area,box_centre = tracker.update(cur_im)
+                if best_box is None:
+                    display.show('Humanfeed',cur_im)
+                    control.lost() #stops the robot once, not on every missed frame
+                    continue
+                if tracker.is_tracking: display.show('Humanfeed',cur_im.copy(),lambda im: draw_detections(im,[best_box],['tracked'],[tracker.confidence]))
+
+                if recorder is not None: recorder.detections(seq,'doll',np.array([best_box+[tracker.confidence,0]],np.float32),stamp)
+                control.measure(box_centre[0],stamp) #stamp lets the loop correct for how old the frame is
+                val = control.output if control.output is not None else 0.0
+                print(f'Bottom Edge: {best_box[3]}, PID Turn %{-val}')
+
+                if (box_area > 54000 and best_box[3] > 690): #for 720p #box_area > 64000 #abs(val) < 15 and #TODO: TUNE THIS
+                    reached = True
+                    break
+        print(f'grab_doll: {tracker.detections} detections, {tracker.tracked} tracked frames, control {control.stats()}, video {robot.stream_stats()}')
+        if reached: #the loop has stopped the robot, finish the approach with blocking moves
+            if -val > 5: robot.turn(8)
+            elif -val < -5: robot.turn(-8)
+            robot.move(x=0.3,speed=0.1)
         #TODO: find better way than this
         #robot.move(x=0.2,speed=0.1)
-        robot.close_claw()
-        time.sleep(1)
+        robot.wait(robot.close_claw(),1)
 
     
     #facing forwards
-    if check_doll(): doll_pos = 2
+    if check_doll('forward'): doll_pos = 2
     robot.turn(-90)
     #facing left
-    if check_doll(): doll_pos = 1
+    if check_doll('left'): doll_pos = 1
     robot.turn(180)
     #facing right
-    if check_doll(): doll_pos = 3
+    if check_doll('right'): doll_pos = 3
 
     #from facing right...
     if doll_pos==1: robot.turn(-180)
@@ -142,7 +175,11 @@ with Robot() as robot:
 
     grab_doll()
 
+    print(f'snaps per decision: {scan_log}, {sum(f for _,f,_ in scan_log)} in total')
     print("Completed!")
+display.stop()
+if recorder is not None: recorder.stop()
+if server is not None: server.stop()
 
 '''
 https://robomaster-dev.readthedocs.io/en/latest/sdk/api.html
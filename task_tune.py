@@ -1,71 +1,103 @@
-import cv2
-from models import get_human_model, get_clothes_model, get_most_confident, visualize, crop_bbox, id_to_label, metadata
+import argparse
+import json
+import numpy as np
+from models import get_human_model, get_clothes_model, get_metadata, DetectionPipeline, MotionGate
+from display import Display
 from robot import Robot
+from sweep import build_cache, parse_scan, sweep
 import time
+from threading import Thread
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--headless',action='store_true',help='no windows or drawing, for competition runs')
+parser.add_argument('--build-cache',nargs='+',type=parse_scan,metavar='GLOB=WORN',help='cache raw detections of recorded scans for --sweep instead of running the robot, see sweep.py')
+parser.add_argument('--sweep',action='store_true',help='replay threshold & coefficient grids on --cache instead of running the robot')
+parser.add_argument('--cache',default='tune_cache.npz')
+parser.add_argument('--out',default='tune_results.jsonl',help='file the sweep results are written to')
+parser.add_argument('--workers',type=int,default=None,help='sweep processes, default one per core')
+parser.add_argument('--snaps',type=int,default=5,help='confirming snaps per decision in the sweep')
+parser.add_argument('--human-nms',type=float,nargs='+',default=[0.0,0.3,0.5])
+parser.add_argument('--human-score',type=float,nargs='+',default=[0.9,0.95,0.99])
+parser.add_argument('--clothes-nms',type=float,nargs='+',default=[0.2,0.3,0.5])
+parser.add_argument('--clothes-score',type=float,nargs='+',default=[0.5,0.6,0.7,0.75])
+parser.add_argument('--penalty',type=float,nargs='+',default=[0.1,0.3,0.5],help='weight taken off per unwanted clothes score')
+parser.add_argument('--sureness',type=float,nargs='+',default=[0.3,0.4,0.5],help='mean score per snap & wanted item needed to match')
+args = parser.parse_args()
 
-#nms is threshold for IoU, score is threshold for confidence
-human_model = get_human_model(nms_thres=0.0,score_thres=0.95)
-clothes_model = get_clothes_model(nms_thres=0.3,score_thres=0.75)
 wanted_clothing = ['tops']
 
-def find_doll(im):
-    human_boxes = human_model(im)
-    best_box = get_most_confident(human_boxes) #returns only 1 box in Boxes
-    if len(best_box) == 0: return None,None,None
-    box_area = best_box.area().tolist()[0]
-    box_centre = best_box.get_centers().tolist()[0]
-    cv2.imshow('Humanfeed',visualize(im,human_boxes))
+if args.build_cache or args.sweep: #offline tuning, no robot
+    if args.build_cache: build_cache(args.build_cache,args.cache)
+    if args.sweep:
+        rows = sweep(args.cache,wanted_clothing,args.human_nms,args.human_score,args.clothes_nms,args.clothes_score,
+            args.penalty,args.sureness,snaps=args.snaps,workers=args.workers)
+        with open(args.out,'w') as f:
+            for r in rows: f.write(json.dumps(r)+'\n')
+        for r in rows[:10]: print(r)
+        print(f'{len(rows)} combinations written to {args.out}')
+    raise SystemExit
+
+display = Display(['Livefeed','Humanfeed','Clothesfeed'],headless=args.headless).start()
+
+#nms is threshold for IoU, score is threshold for confidence
+human_model = clothes_model = None
+def load_models():
+    '''Builds the predictors, run in the background while the robot connects.'''
+    global human_model,clothes_model
+    human_model = get_human_model(nms_thres=0.0,score_thres=0.95,batch=True)
+    clothes_model = get_clothes_model(nms_thres=0.3,score_thres=0.75,batch=True)
+
+human_gate = MotionGate() #reuse person boxes in check_doll while the scene is unchanged, the garment model always runs so no snap is a copy
+
+def show_doll(im,human_boxes,box_area,box_centre):
+    display.show_instances('Humanfeed',im,human_boxes,['person'])
     print(f'box area: {box_area}, box centre: {box_centre}')
-    return best_box.tensor.tolist()[0],box_area,box_centre
 
+loader = Thread(target=load_models,daemon=True)
+loader.start()
 with Robot('192.168.2.1') as robot:
     robot.reset_origin()
     robot.cam_doll()
 
-    def check_doll():
+    def check_doll(min_fresh=0.3):
+        '''min_fresh is the fraction of snaps whose person box must come from fresh inference rather than the motion-gated cache'''
         confirming_snaps = 5 #number of confirming pictures to take (the more the better)
 
-        cat_scores = {k:0.0 for k in metadata.thing_classes}
-        doll_score = 0.0
+        class_names = get_metadata().thing_classes
+        cat_scores = np.zeros(len(class_names)) #summed score per class, same order as class_names
         snaps = 0 #number of pictures taken
-        while snaps < confirming_snaps:
-            if not robot.hasNewFrame: continue
-            robot.hasNewFrame = False
-            cur_im = robot.frame.copy()
-            cv2.imshow('Livefeed',cur_im)
-            
-            cv2.waitKey(1)
-            if cv2.getWindowProperty('Livefeed',cv2.WND_PROP_VISIBLE) < 1: break
-
-            best_box,_,_ = find_doll(cur_im)
-            if best_box is None: 
-                cv2.imshow('Humanfeed',cur_im)
-                continue
-
-            new_im,_ = crop_bbox(cur_im,best_box,b=0.1) #b is the extra margin
-            outputs = clothes_model(new_im)['instances'].to('cpu')
-            cv2.imshow('Clothesfeed',visualize(new_im,{'instances':outputs}))
-            if len(outputs) == 0: continue
-
-            classes = id_to_label(outputs.pred_classes.tolist())
-            scores = outputs.scores.tolist()
-            bboxes = outputs.pred_boxes.tensor.tolist()
-            for cat,score,bbox in zip(classes,scores,bboxes):
-                cat_scores[cat] += score
-            snaps += 1
-
-        print(cat_scores)
-        for cat,score in cat_scores.items():
-            if cat in wanted_clothing: doll_score += score
-            else: doll_score -= 0.3*score #is arbitrary coefficient
+        source = lambda seq: robot.wait_frame(seq,timeout=0.5)
+        human_gate.reset_stats()
+        with DetectionPipeline(source,human_model,clothes_model,margin=0.1,after_seq=robot.frames.seq,batch_size=confirming_snaps,
+                human_gate=human_gate,min_fresh=min_fresh) as pipeline: #b is the extra margin, snaps are scored in one batch
+            while snaps < confirming_snaps:
+                r = pipeline.get(timeout=1.0)
+                if r is None: continue
+                display.show('Livefeed',r.im)
+                if display.closed('Livefeed'): break
+
+                if r.box is None:
+                    display.show('Humanfeed',r.im)
+                    continue
+                show_doll(r.im,r.human_outputs,r.box_area,r.box_centre)
+
+                outputs = r.clothes_outputs['instances']
+                display.show_instances('Clothesfeed',r.crop,outputs,class_names)
+                if len(outputs) == 0: continue
+
+                cat_scores += r.clothes_scores
+                snaps += 1
+
+        print(f'person cache hits/misses: {human_gate.window_hits}/{human_gate.window_misses}')
+        print(dict(zip(class_names,cat_scores.tolist())))
+        weights = np.array([1.0 if cat in wanted_clothing else -0.3 for cat in class_names]) #-0.3 is arbitrary coefficient
+        doll_score = float(cat_scores@weights)
 
         print(f'score: {doll_score}, threshold: {confirming_snaps*len(wanted_clothing)*0.5}')
 
-    cv2.namedWindow('Livefeed', cv2.WINDOW_AUTOSIZE)
+    loader.join()
     while True:
-        cv2.namedWindow('Humanfeed', cv2.WINDOW_AUTOSIZE)
-        cv2.namedWindow('Clothesfeed', cv2.WINDOW_AUTOSIZE)
         check_doll()
-        if cv2.getWindowProperty('Livefeed',cv2.WND_PROP_VISIBLE) < 1: break
+        if display.closed('Livefeed'): break
 
-    cv2.destroyAllWindows()
\ No newline at end of file
+display.stop()
\ No newline at end of file
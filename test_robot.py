@@ -0,0 +1,111 @@
+'''
+Reply matching of Robot's control connection against a local TCP stand-in for the robot, and ControlLoop against a fake one.
+python -m pytest test_robot.py
+'''
+import socket
+import numpy as np
+from threading import Thread
+from time import sleep, time
+from robot import Robot, FrameBuffer, REPLY_IDLE
+
+def connect():
+    '''(robot, server side socket) with only the control feedback thread running.'''
+    server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    server.bind(('127.0.0.1',0))
+    server.listen(1)
+    robot = Robot('127.0.0.1')
+    robot.ctrl_sock.connect(server.getsockname())
+    conn,_ = server.accept()
+    server.close()
+    robot.isOpen = True
+    Thread(target=robot._Robot__recvmsg,daemon=True).start()
+    return robot,conn
+
+def close(robot,conn):
+    robot.isOpen = False
+    conn.close()
+    robot.ctrl_sock.close()
+
+def test_split_reply_is_reassembled():
+    robot,conn = connect()
+    try:
+        first,second = robot.send('chassis move x 0.1'),robot.send('chassis move x 0.2')
+        conn.sendall(b'o')
+        sleep(REPLY_IDLE/5) #well inside the idle time, the rest is still on its way
+        conn.sendall(b'k;')
+        assert first.result(1) == 'ok'
+        sleep(REPLY_IDLE*4)
+        assert not second.done() #its reply hasn't been sent yet
+        conn.sendall(b'error;')
+        assert second.result(1) == 'error'
+    finally: close(robot,conn)
+
+def test_several_replies_in_one_read():
+    robot,conn = connect()
+    try:
+        futs = [robot.send('command') for _ in range(3)]
+        conn.sendall(b'ok;ok;1.0 2.0 3.0;')
+        assert [f.result(1) for f in futs] == ['ok','ok','1.0 2.0 3.0']
+    finally: close(robot,conn)
+
+def test_unterminated_reply_completes_when_idle():
+    robot,conn = connect()
+    try:
+        fut = robot.send('command')
+        conn.sendall(b'ok')
+        assert fut.result(1) == 'ok'
+    finally: close(robot,conn)
+
+def test_command_error_does_not_shift_later_replies():
+    robot,conn = connect()
+    try:
+        bad,good = robot.command('robotic_gripper open 4'),robot.command('robotic_gripper close 2')
+        conn.sendall(b'error;ok;')
+        assert isinstance(bad.exception(1),Exception)
+        assert good.result(1) == 'ok'
+    finally: close(robot,conn)
+
+class R:
+    '''Records the speed commands ControlLoop sends instead of driving anything.'''
+    def __init__(self): self.speeds = []
+    def speed(self,x=0.0,y=0.0,z=0.0): self.speeds.append((x,y,z))
+
+def control_loop(**kwargs):
+    from robot import PID, ControlLoop
+    robot = R()
+    return robot,ControlLoop(robot,PID(640.0,0.25,0.0,0.0),lambda val: (35,0,-val),rate=50,**kwargs)
+
+def test_late_measurements_keep_driving():
+    robot,control = control_loop()
+    with control:
+        for _ in range(4): #each one arrives 0.8s after its frame, as from a slow detector
+            control.measure(600.0,time()-0.8)
+            sleep(0.3)
+        assert control.output is not None
+    driving = [s for s in robot.speeds if any(s)]
+    assert driving and driving[0] == (35.0,0.0,-10.0) #drove on them instead of stopping
+    assert all(any(s) for s in robot.speeds[robot.speeds.index(driving[0]):-1]) #and only stop() stopped it after that
+
+def test_stops_when_lost_or_measurements_stop():
+    robot,control = control_loop(max_age=0.2)
+    with control:
+        control.measure(600.0)
+        sleep(0.1)
+        control.lost()
+        sleep(0.1)
+        assert robot.speeds[-1] == (0.0,0.0,0.0)
+        control.measure(600.0)
+        sleep(0.1)
+        assert robot.speeds[-1] != (0.0,0.0,0.0)
+        sleep(0.3) #no new measurement within max_age
+        assert robot.speeds[-1] == (0.0,0.0,0.0)
+
+def test_dropped_counts_only_frames_a_waiting_consumer_skipped():
+    frames = FrameBuffer()
+    im = np.zeros((2,2,3),np.uint8)
+    for _ in range(30): frames.publish(im) #nobody reading, eg. while the robot moves
+    seq,_,_ = frames.wait(-1,timeout=1)
+    assert frames.dropped == 0
+    for _ in range(3): frames.publish(im) #inference fell behind by two frames
+    frames.wait(seq,timeout=1)
+    assert frames.dropped == 2
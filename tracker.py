@@ -0,0 +1,101 @@
+import numpy as np
+import cv2
+
+LK_PARAMS = dict(winSize=(21,21),maxLevel=3,criteria=(cv2.TERM_CRITERIA_EPS|cv2.TERM_CRITERIA_COUNT,20,0.03))
+
+def box_stats(box):
+    '''(box, area, centre) the way find_doll returns them.'''
+    x1,y1,x2,y2 = box
+    return [x1,y1,x2,y2],(x2-x1)*(y2-y1),[(x1+x2)/2.0,(y1+y2)/2.0]
+
+class DollTracker:
+    '''
+    Detect-then-track for the grab_doll servo loop. A detection seeds Lucas-Kanade optical flow on corners inside the doll's box,
+    which then moves & scales the box every frame. The detector only runs every redetect_every frames, or as soon as tracking gets unreliable.
+    update() returns the same (box, area, centre) as find_doll, so the PID & stop condition don't change.
+    - detect (callable): detect(im) -> (box, area, centre), (None, None, None) if nothing found, eg. find_doll
+    - redetect_every (int, default: 10): frames between detections, 1 detects on every frame
+    - min_confidence (float, default: 0.5): re-detect when fewer than this fraction of the seeded points are still tracked
+    - max_fb_error (number, default: 1.0): points that don't come back within this many pixels when tracked backwards are dropped
+    - max_points (int, default: 100): corners seeded per detection
+    '''
+    def __init__(self,detect,redetect_every=10,min_confidence=0.5,max_fb_error=1.0,max_points=100):
+        self.detect = detect
+        self.redetect_every = redetect_every
+        self.min_confidence = min_confidence
+        self.max_fb_error = max_fb_error
+        self.max_points = max_points
+        self.reset()
+        self.detections = 0 #detector calls
+        self.tracked = 0 #frames answered by the tracker alone
+
+    def reset(self):
+        '''Forget the current track, the next update() runs the detector.'''
+        self.box = None
+        self.points = None
+        self.seeded = 0
+        self.prev_gray = None
+        self.since_detect = 0
+        self.confidence = 0.0
+
+    def __seed(self,gray,box):
+        x1,y1,x2,y2 = [int(round(v)) for v in box]
+        mx,my = (x2-x1)//10,(y2-y1)//10 #stay off the box edges, they are mostly background
+        mask = np.zeros_like(gray)
+        mask[max(0,y1+my):max(0,y2-my),max(0,x1+mx):max(0,x2-mx)] = 255
+        points = cv2.goodFeaturesToTrack(gray,self.max_points,0.01,5,mask=mask)
+        self.points = points if points is not None else np.empty((0,1,2),np.float32)
+        self.seeded = len(self.points)
+        self.confidence = 1.0 if self.seeded else 0.0
+
+    def __track(self,gray):
+        '''Moves the box from prev_gray to gray. Returns False if the track was lost.'''
+        if self.seeded == 0 or len(self.points) < 4: return False
+        p1,st,_ = cv2.calcOpticalFlowPyrLK(self.prev_gray,gray,self.points,None,**LK_PARAMS)
+        p0r,st_r,_ = cv2.calcOpticalFlowPyrLK(gray,self.prev_gray,p1,None,**LK_PARAMS)
+        fb_error = np.abs(self.points-p0r).reshape(-1,2).max(axis=1)
+        good = (st.ravel() == 1)&(st_r.ravel() == 1)&(fb_error < self.max_fb_error)
+        self.confidence = good.sum()/self.seeded
+        if good.sum() < 4 or self.confidence < self.min_confidence: return False
+
+        old,new = self.points[good].reshape(-1,2),p1[good].reshape(-1,2)
+        dx,dy = np.median(new-old,axis=0)
+        i,j = np.triu_indices(len(old),k=1) #scale from how the distances between points changed
+        d_old = np.linalg.norm(old[i]-old[j],axis=1)
+        d_new = np.linalg.norm(new[i]-new[j],axis=1)
+        valid = d_old > 1.0
+        scale = float(np.median(d_new[valid]/d_old[valid])) if valid.any() else 1.0
+
+        x1,y1,x2,y2 = self.box
+        cx,cy = (x1+x2)/2.0+dx,(y1+y2)/2.0+dy
+        hw,hh = (x2-x1)/2.0*scale,(y2-y1)/2.0*scale
+        h,w = gray.shape[:2]
+        self.box = [float(max(0,cx-hw)),float(max(0,cy-hh)),float(min(w,cx+hw)),float(min(h,cy+hh))]
+        self.points = p1[good]
+        return True
+
+    def update(self,im):
+        '''Box of the doll in im as (box, area, centre), or (None, None, None) if neither tracker nor detector found it.'''
+        gray = cv2.cvtColor(im,cv2.COLOR_BGR2GRAY)
+        tracked = (self.box is not None and self.since_detect < self.redetect_every-1 and self.__track(gray))
+        if tracked:
+            self.since_detect += 1
+            self.tracked += 1
+            self.prev_gray = gray
+            return box_stats(self.box)
+
+        self.detections += 1
+        box,area,centre = self.detect(im)
+        if box is None:
+            self.reset()
+            return None,None,None
+        self.box = list(box)
+        self.since_detect = 0
+        self.prev_gray = gray
+        self.__seed(gray,box)
+        return box,area,centre
+
+    @property
+    def is_tracking(self):
+        '''Whether the last update() came from the tracker rather than the detector.'''
+        return self.box is not None and self.since_detect > 0